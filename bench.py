@@ -0,0 +1,321 @@
+'''
+Benchmarks for pyissues and dirshelve.
+
+    python bench.py [count] [--output results.json] [--compare old.json]
+
+Builds a synthetic tracker of count issues (deterministic for a given
+--seed) and times the core PyIssues and DirShelf operations plus some
+end to end CLI commands.  Reports throughput, latency percentiles and
+peak memory, and can save the results as JSON and compare them against
+an earlier run.
+'''
+import sys, os, time, tempfile, shutil, random, json, resource, subprocess, argparse, platform
+
+import pyissues, dirshelve
+
+OWNERS = [ 'user{0:02d}'.format(i) for i in range(20) ]
+WORDS = ('crash', 'login', 'page', 'slow', 'error', 'button', 'report', 'export', 'search', 'upload',
+         'timeout', 'memory', 'display', 'settings', 'email', 'broken', 'missing', 'wrong', 'fails', 'user')
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+def peak_memory(who=resource.RUSAGE_SELF):
+    '''
+    Peak resident set size in MB.
+    '''
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def summarise(latencies, ops=None):
+    '''
+    Summary of a list of per call latencies in seconds, ops is the number
+    of items each call handled.
+    '''
+    total = sum(latencies)
+    ops = (ops or 1) * len(latencies)
+    return {'calls': len(latencies), 'total': total, 'rate': ops / total if total else None,
+            'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99), 'max': max(latencies),
+            'memory': peak_memory()}
+
+def measure(func, args_list, ops=None):
+    latencies = []
+    for args in args_list:
+        start = time.time()
+        func(*args)
+        latencies.append(time.time() - start)
+    return summarise(latencies, ops)
+
+def make_issue(rng, i, start):
+    '''
+    A realistic looking issue dict, the same for a given rng state.
+    '''
+    status = rng.choice(['open'] * 12 + ['closed'] * 7 + ['archived'])
+    # a few people own most of the issues
+    owner = OWNERS[min(int(rng.expovariate(0.25)), len(OWNERS) - 1)]
+    assigned = rng.choice(['no-one'] * 4 + OWNERS[:8])
+    created = start + rng.randint(0, 3 * 365 * 86400)
+    stamp = lambda t: time.strftime(pyissues.DATETIME_FORMAT, time.gmtime(t))
+
+    comments = []
+    for j in range(min(int(rng.expovariate(0.5)), 20)):
+        comments.append([' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 40))),
+                         rng.choice(OWNERS), stamp(created + j * 3600)])
+
+    return {
+        'uuid': '{0:032x}'.format(rng.getrandbits(128)),
+        'description': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 8))).capitalize(),
+        'status': status,
+        'owner': owner,
+        'assigned': assigned,
+        'priority': rng.choice(['low', 'medium', 'medium', 'medium', 'high', 'blocker']),
+        'version': rng.choice(pyissues.conf.version),
+        'milestone': rng.choice(pyissues.conf.milestone),
+        'created': stamp(created),
+        'updated': stamp(created + rng.randint(0, 90 * 86400)),
+        'body': '\n'.join(' '.join(rng.choice(WORDS) for _ in range(12)) for _ in range(rng.randint(1, 15))),
+        'comments': comments,
+        'attachments': [],
+    }
+
+def generate(directory, count, seed=0, attachments=0.05):
+    '''
+    Build a tracker of count issues in directory.
+    A fraction of the issues get one of a small set of shared attachments.
+    Returns the list of uuids.
+    '''
+    rng = random.Random(seed)
+    start = 1356998400 # 2013-01-01
+
+    issues = pyissues.PyIssues(directory)
+    store = pyissues.BlobStore("{0}/files/blobs".format(directory))
+    digests = []
+    source = os.path.join(directory, '.attachment')
+    for i in range(20):
+        with open(source, 'wb') as f:
+            f.write(''.join(chr(rng.randint(0, 255)) for _ in range(rng.randint(1, 64) * 1024)))
+        digests.append(store.put(source))
+    os.unlink(source)
+
+    uuids = []
+    def items():
+        for i in range(count):
+            issue = make_issue(rng, i, start)
+            if rng.random() < attachments:
+                digest = rng.choice(digests)
+                issue['attachments'] = [['file{0}.bin'.format(i), pyissues.blobs.PREFIX + digest, issue['owner'], issue['created']]]
+            uuids.append(issue['uuid'])
+            yield json.dumps(issue)
+
+    issues.import_issues(items())
+    issues.close()
+    return uuids
+
+def bench_pyissues(directory, uuids, ops=200, seed=0):
+    rng = random.Random(seed)
+    sample = [ rng.choice(uuids) for _ in range(ops) ]
+    results = {}
+
+    def cold():
+        issues = pyissues.PyIssues(directory)
+        issues.filter({'status': 'open'}, sort='-created', limit=20)
+    results['cold list'] = measure(cold, [()] * 5)
+
+    issues = pyissues.PyIssues(directory)
+    issues.issues_data
+    n = len(issues.issues_data)
+
+    results['filter all'] = measure(issues.filter, [()] * 5, n)
+    results['filter status'] = measure(issues.filter, [({'status': 'open'}, )] * 5, n)
+    results['filter sort'] = measure(issues.filter, [(None, '-priority,created')] * 5, n)
+    results['filter top 20'] = measure(issues.filter, [(None, '-priority,created', 20)] * 20, n)
+    results['filter created 20'] = measure(issues.filter, [({'status': 'open'}, '-created', 20)] * 20, n)
+    dashboard = "priority in (high, blocker) and created >= 2015-01-01 and assigned != no-one"
+    results['filter query'] = measure(issues.filter, [(dashboard, '-created', 20)] * 20, n)
+    results['filter query selective'] = measure(issues.filter, [("owner = user19 and priority = blocker", '-created', 20)] * 20, n)
+    results['filter lambda'] = measure(issues.filter, [(lambda x: x['priority'] in ('high', 'blocker') and x['created'] >= '2015-01-01'
+                                                        and x['assigned'] != 'no-one', '-created', 20)] * 20, n)
+    results['match'] = measure(issues.match, [ (x[:8], ) for x in sample ])
+    results['get'] = measure(issues.get, [ (x, ) for x in sample ])
+    results['search'] = measure(issues.search, [ (rng.choice(WORDS), 20) for _ in range(20) ])
+    results['stats'] = measure(issues.stats, [('status', 'assigned')] * 20)
+
+    loaded = [ issues.get(x) for x in sample ]
+    results['update'] = measure(issues.update, [ (x, ) for x in loaded ])
+    results['flush'] = measure(lambda: (issues._record(loaded[0].uuid, loaded[0].index(issues.settings['_index'])), issues.flush()),
+                               [()] * 5)
+    issues.close()
+
+    def rebuild(incremental):
+        issues = pyissues.PyIssues(directory)
+        issues.rebuild(incremental=incremental)
+        issues.close()
+    results['rebuild'] = measure(rebuild, [(False, )], len(uuids))
+    results['rebuild incremental'] = measure(rebuild, [(True, )] * 3)
+    return results
+
+def bench_dirshelf(count=10000, seed=0):
+    rng = random.Random(seed)
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        keys = [ 'key{0}'.format(i) for i in range(count) ]
+        values = [ {'n': i, 'text': ' '.join(rng.choice(WORDS) for _ in range(20))} for i in range(count) ]
+
+        for name in ('pickle', 'marshal', 'json'):
+            serializer = pyissues.serializers.Store(name)
+            d = dirshelve.open(os.path.join(directory, name), serializer=serializer)
+            results['set ' + name] = measure(d.__setitem__, zip(keys, values))
+            d.close()
+            d = dirshelve.open(os.path.join(directory, name), serializer=serializer, cache_size=0)
+            results['get ' + name] = measure(d.__getitem__, [ (x, ) for x in keys ])
+            d.close()
+
+        d = dirshelve.open(os.path.join(directory, 'pickle'), writeback=True)
+        for x in keys:
+            d[x]['n'] += 1
+        results['sync'] = measure(d.sync, [()], count)
+        results['len'] = measure(d.__len__, [()] * 20)
+        d.close()
+        results['open'] = measure(lambda: dirshelve.open(os.path.join(directory, 'pickle')).close(), [()] * 5)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def bench_cli(directory, uuids, repeat=5):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts', 'pyissues')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    results = {}
+
+    def run(*args):
+        with open(os.devnull, 'w') as null:
+            subprocess.check_call([sys.executable, script, '-d', directory, '--local'] + list(args), stdout=null, env=env)
+
+    for name, args in [('start', ('--help', )), ('list', ('list', '--limit=20')), ('show', ('show', uuids[0][:8])),
+                       ('stats', ('stats', 'status', 'assigned')), ('search', ('search', WORDS[0], '-n', '20'))]:
+        results[name] = measure(run, [args] * repeat)
+        results[name]['memory'] = peak_memory(resource.RUSAGE_CHILDREN)
+    return results
+
+def bench_serializers(count=1000):
+    '''
+    Time storing and loading count issues with each object serializer.
+    Returns {serializer: (update seconds, get seconds)}.
+    '''
+    results = {}
+    for name in ('json', 'marshal'):
+        directory = tempfile.mkdtemp()
+        try:
+            issues = pyissues.PyIssues(directory)
+            issues.serializer = pyissues.serializers.Store(name)
+
+            items = []
+            for i in range(count):
+                issue = issues.create(description="Issue {0}".format(i), body="Some text\n" * 20)
+                for j in range(5):
+                    issue.add_comment("Comment {0}".format(j), "bob")
+                items.append(issue)
+
+            def update():
+                for issue in items:
+                    issues.update(issue)
+
+            def get():
+                for issue in items:
+                    issues.get(issue.uuid)
+
+            results[name] = (timed(update), timed(get))
+            issues.close()
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+def report(results, baseline=None, threshold=0.1):
+    '''
+    Print a table of results, with the change in p50 against baseline.
+    Returns the names that got slower by more than threshold.
+    '''
+    template = "{0:30s} {1:>10s} {2:>10s} {3:>10s} {4:>10s} {5:>8s} {6:>8s}"
+    print template.format('benchmark', 'rate/s', 'p50 ms', 'p90 ms', 'p99 ms', 'mem MB', 'change')
+    print '-' * 92
+
+    slower = []
+    for name in sorted(results):
+        r = results[name]
+        change = ''
+        if baseline and name in baseline and baseline[name]['p50']:
+            ratio = r['p50'] / baseline[name]['p50']
+            change = '{0:+.0%}'.format(ratio - 1)
+            if ratio > 1 + threshold:
+                slower.append(name)
+                change += ' !'
+        print template.format(name, '{0:.0f}'.format(r['rate']) if r['rate'] else '-',
+                              *[ '{0:.2f}'.format(r[x] * 1000) for x in ('p50', 'p90', 'p99') ] +
+                              [ '{0:.0f}'.format(r['memory']), change ])
+    return slower
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark pyissues")
+    parser.add_argument('count', type=int, nargs='?', default=1000, help='Issues to generate (1k to 1M)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ops', type=int, default=200, help='Calls to time for the per issue operations')
+    parser.add_argument('--only', default='pyissues,dirshelf,cli,serializers', help='Comma separated suites to run')
+    parser.add_argument('--keep', default=None, help='Generate the tracker here and keep it')
+    parser.add_argument('--output', '-o', default=None, help='Save the results as JSON')
+    parser.add_argument('--compare', '-c', default=None, help='Compare against saved results')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Slowdown to report as a regression')
+    options = parser.parse_args()
+
+    suites = options.only.split(',')
+    results = {}
+
+    if 'pyissues' in suites or 'cli' in suites:
+        directory = options.keep or tempfile.mkdtemp()
+        try:
+            elapsed = time.time()
+            uuids = generate(directory, options.count, options.seed)
+            results['generate'] = summarise([time.time() - elapsed], options.count)
+
+            if 'pyissues' in suites:
+                for name, r in bench_pyissues(directory, uuids, options.ops, options.seed).items():
+                    results['pyissues ' + name] = r
+            if 'cli' in suites:
+                for name, r in bench_cli(directory, uuids).items():
+                    results['cli ' + name] = r
+        finally:
+            if not options.keep:
+                shutil.rmtree(directory)
+
+    if 'dirshelf' in suites:
+        for name, r in bench_dirshelf(min(options.count, 10000), options.seed).items():
+            results['dirshelf ' + name] = r
+
+    if 'serializers' in suites:
+        count = min(options.count, 1000)
+        for name, (update, get) in bench_serializers(count).items():
+            results['serializer {0} update'.format(name)] = summarise([update], count)
+            results['serializer {0} get'.format(name)] = summarise([get], count)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+
+    slower = report(results, baseline, options.threshold)
+
+    if options.output:
+        meta = {'count': options.count, 'seed': options.seed, 'python': platform.python_version(),
+                'platform': platform.platform(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with open(options.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2, sort_keys=True)
+
+    if slower:
+        print "\nSlower than baseline: {0}".format(', '.join(slower))
+        sys.exit(1)
@@ -4,6 +4,11 @@ dirshelve.py, v0.1
 Implements shelve API using files in a directory.
 Supports path type keys e.g. 'subdir/testing'.
 Implements smart writeback.
+Keeps a bounded LRU cache - dirty items are written back when evicted.
+Keeps a key manifest so len/iteration/membership don't walk the tree.
+Optionally fans files out into hashed subdirectories (fanout=2 gives ab/cd/key).
+Values are pickled by default, any object with dumps/loads methods can be
+given as the serializer instead e.g. pyissues.serializers.Store('marshal').
 
     import dirshelve
     
@@ -20,58 +25,251 @@ Implements smart writeback.
 
 '''
 
-from collections import MutableMapping
-import os, logging
-
-fopen = __builtins__['open']
-
-logger = logging.getLogger(__name__)
+from collections import MutableMapping, OrderedDict
+import os, logging, hashlib, json, urllib
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+fopen = __builtins__['open']
+
+logger = logging.getLogger(__name__)
+
+# values of these types can't be changed in place so never need re-checking
+IMMUTABLE = (str, unicode, int, long, float, bool, type(None))
 
-def open(dirname, writeback=False):
-    return DirShelf(dirname, writeback)
+TEMP_SUFFIX = '.dirshelf-tmp'
+
+MANIFEST = '.dirshelf-keys'
+
+def open(dirname, writeback=False, cache_size=1000, fanout=0, serializer=None):
+    return DirShelf(dirname, writeback, cache_size, fanout, serializer)
+
+def _digest(data):
+    return hashlib.md5(data).digest()
+
+class PickleSerializer(object):
+    '''
+    The default serializer.
+    '''
+    def dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    
+    def loads(self, data):
+        return pickle.loads(data)
 
 class DirShelf(MutableMapping):
     
-    def __init__(self, dirname, writeback=False):
+    def __init__(self, dirname, writeback=False, cache_size=1000, fanout=0, serializer=None):
         self.dirname = os.path.realpath(dirname)
+        self.serializer = serializer or PickleSerializer()
         
         self.writeback = writeback
-        self._cache = {}
-        self._initial = {}
+        self.cache_size = cache_size
+        
+        # name -> value, least recently used first
+        self._cache = OrderedDict()
+        
+        # writeback only: name -> digest of the value as read, None if dirty.
+        # Immutable values are only tracked once assigned, and everything
+        # is tracked afresh from its next access after a sync.
+        self._initial = OrderedDict()
         
         if not os.path.isdir(self.dirname):
             os.makedirs(self.dirname)
         
+        # directories we know exist
+        self._dirs = set([self.dirname])
+        
+        self._manifest_file = os.path.join(self.dirname, MANIFEST)
+        # opened on the first change so read only shelves never write
+        self._log = None
+        self._load_manifest(fanout)
+        
     def close(self):
         self.sync()
+        if self._log is not None:
+            self._log.close()
         self.dirname = None
         self._cache = None
         self._initial = None
+        self._manifest = None
+    
+    def _load_manifest(self, fanout):
+        '''
+        The manifest is a JSON header with the layout followed by a log of
+        +key / -key lines.  Shelves without one are walked once to create it.
+        '''
+        self._manifest = set()
+        self._log_lines = 0
+        try:
+            with fopen(self._manifest_file, 'rb') as f:
+                self.fanout = json.loads(f.readline())['fanout']
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    key = urllib.unquote(line[1:-1])
+                    if line[0] == '+':
+                        self._manifest.add(key)
+                    else:
+                        self._manifest.discard(key)
+                    self._log_lines += 1
+            if fanout != self.fanout:
+                logger.debug("Using existing fanout of {0}".format(self.fanout))
+        except IOError:
+            self.fanout = self._detect_fanout(fanout)
+            self._manifest = set(self._walk())
+            try:
+                self._compact()
+            except (IOError, OSError):
+                logger.debug("Unable to write manifest for {0}".format(self.dirname))
+    
+    def _detect_fanout(self, fanout):
+        '''
+        The layout of a shelf without a manifest, from its first file.
+        Fanned out files sit under directories named from the hash of the
+        file name, anything else is a plain layout.  Empty shelves use fanout.
+        '''
+        for root, dirs, files in os.walk(self.dirname):
+            for x in files:
+                if x.endswith(TEMP_SUFFIX) or (x == MANIFEST and root == self.dirname):
+                    continue
+                parts = root[len(self.dirname) + 1:].split(os.sep) if root != self.dirname else []
+                h = hashlib.md5(x).hexdigest()
+                if parts and parts == [ h[i * 2:i * 2 + 2] for i in range(len(parts)) ]:
+                    return len(parts)
+                return 0
+        return fanout
+    
+    def _compact(self):
+        '''
+        Rewrite the manifest as just the current keys.
+        '''
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        
+        temp = self._manifest_file + TEMP_SUFFIX
+        with fopen(temp, 'wb') as f:
+            f.write(json.dumps({'fanout': self.fanout}) + '\n')
+            for key in self._manifest:
+                f.write('+' + self._quote(key) + '\n')
+        os.rename(temp, self._manifest_file)
+        
+        self._log_lines = len(self._manifest)
+    
+    def _track(self, name, present):
+        if present == (name in self._manifest):
+            return
+        if present:
+            self._manifest.add(name)
+        else:
+            self._manifest.discard(name)
+        if self._log is None:
+            self._log = fopen(self._manifest_file, 'ab')
+        self._log.write(('+' if present else '-') + self._quote(name) + '\n')
+        self._log.flush()
+        self._log_lines += 1
+    
+    def _quote(self, name):
+        return urllib.quote(name.encode('utf-8') if isinstance(name, unicode) else name, safe='')
+    
+    def _walk(self):
+        c = len(self.dirname) + 1
+        for root, dirs, files in os.walk(self.dirname):
+            for x in files:
+                if x.endswith(TEMP_SUFFIX) or (x == MANIFEST and root == self.dirname):
+                    continue
+                yield urllib.unquote(x) if self.fanout else os.path.join(root[c:], x)
         
     def sync(self):
-        synced = []
+        '''
+        Write back any changed items.
+        All the data is written to temporary files first and then renamed
+        into place.  Returns the names written.
+        Values fetched before a sync must be read from the shelf again for
+        later in place changes to be written.
+        '''
+        changed = []
         for name in self._initial:
-            data = pickle.dumps(self._cache[name])
-            if hash(data) != self._initial[name]:
-                logger.debug("Syncing '{0}'".format(name))
-                with fopen(self._key_path(name), 'wb') as f:
-                    f.write(data)
-                synced.append(name)
-        self._initial = {}
-        return synced
+            data = self._changed(name, self._cache[name])
+            if data is not None:
+                changed.append((name, data))
+        
+        self._write(changed)
+        self._initial.clear()
+        
+        if self._log_lines > 2 * len(self._manifest) + 1000:
+            self._compact()
+        return [ x[0] for x in changed ]
+    
+    def _changed(self, name, value):
+        '''
+        Returns the serialized value if it differs from what is stored, otherwise None.
+        '''
+        digest = self._initial[name]
+        data = self._dumps(value)
+        if digest is not None and _digest(data) == digest:
+            return None
+        return data
+    
+    def _dumps(self, value):
+        return self.serializer.dumps(value)
     
-    def _key_path(self, name):
-        path = os.path.join(self.dirname, name)
+    def _write(self, items):
+        temps = []
         try:
-            os.makedirs(os.path.dirname(path))
-        except OSError:
-            pass
+            for name, data in items:
+                path = self._key_path(name, True)
+                temp = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + TEMP_SUFFIX)
+                with fopen(temp, 'wb') as f:
+                    f.write(data)
+                temps.append((temp, path))
+        except:
+            for temp, _ in temps:
+                os.unlink(temp)
+            raise
+        
+        for (temp, path), (name, _) in zip(temps, items):
+            logger.debug("Syncing '{0}'".format(path))
+            os.rename(temp, path)
+            self._track(name, True)
+    
+    def _cache_item(self, name, value):
+        '''
+        Add an item to the cache, evicting the least recently used if full.
+        '''
+        self._cache[name] = value
+        
+        while self.cache_size and len(self._cache) > self.cache_size:
+            old, value = self._cache.popitem(last=False)
+            if old in self._initial:
+                data = self._changed(old, value)
+                if data is not None:
+                    logger.debug("Evicting dirty '{0}'".format(old))
+                    self._write([(old, data)])
+                del(self._initial[old])
+    
+    def _key_path(self, name, create=False):
+        '''
+        Path for a key, creating its directory first if create is set.
+        '''
+        if self.fanout:
+            h = hashlib.md5(self._quote(name)).hexdigest()
+            path = os.path.join(self.dirname, *[ h[i * 2:i * 2 + 2] for i in range(self.fanout) ] + [self._quote(name)])
+        else:
+            path = os.path.join(self.dirname, name)
+        
+        if create:
+            d = os.path.dirname(path)
+            if not d in self._dirs:
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    pass
+                self._dirs.add(d)
         return path
     
     def _load_item(self, name):
@@ -81,13 +279,22 @@ class DirShelf(MutableMapping):
         except IOError:
             raise KeyError(name)
         
+        value = self.serializer.loads(data)
         if self.writeback:
-            self._initial[name] = hash(data)
-        
-        return pickle.loads(data)
+            self._watch(name, value)
+        return value
+    
+    def _watch(self, name, value):
+        '''
+        Track a mutable value for in place changes.  The digest is of the
+        value serialized now rather than the stored data, which may have
+        been written by another serializer or pickle protocol.
+        '''
+        if not isinstance(value, IMMUTABLE):
+            self._initial[name] = _digest(self._dumps(value))
         
     def _save_item(self, name, value):
-        pickle.dump(value, fopen(self._key_path(name), 'wb'))
+        self._write([(name, self._dumps(value))])
         if name in self._initial:
             del(self._initial[name])
     
@@ -95,19 +302,26 @@ class DirShelf(MutableMapping):
         if self.dirname is None:
             raise ValueError("Shelf is closed")
     
-        if not name in self._cache:
-            self._cache[name] = self._load_item(name)
-        return self._cache[name]
+        try:
+            value = self._cache.pop(name)
+        except KeyError:
+            value = self._load_item(name)
+        else:
+            if self.writeback and not name in self._initial:
+                self._watch(name, value)
+        self._cache_item(name, value)
+        return value
         
     def __setitem__(self, name, value):
         if self.dirname is None:
             raise ValueError("Shelf is closed")
     
-        self._cache[name] = value
+        self._cache.pop(name, None)
         if self.writeback:
             self._initial[name] = None
         else:
             self._save_item(name, value)
+        self._cache_item(name, value)
             
     def __delitem__(self, name):
         try:
@@ -121,15 +335,14 @@ class DirShelf(MutableMapping):
             
         if name in self._initial:
             del(self._initial[name])
+        
+        self._track(name, False)
 
     def _keys(self):
-        keys = set(self._cache.keys())
-        
-        c = len(self.dirname) + 1
-        for root, dirs, files in os.walk(self.dirname):
-            keys.update([ os.path.join(root[c:], x) for x in files ])
-            
-        return keys
+        return self._manifest.union(self._cache)
+    
+    def __contains__(self, name):
+        return name in self._cache or name in self._manifest
 
     def __iter__(self):
         return iter(self._keys())
@@ -1,6 +1,15 @@
-import json, os, datetime, uuid, logging
+import json, os, datetime, logging, contextlib, operator, heapq, itertools, marshal, imp, time
 
 import issues_conf as conf
+import columnar, serializers, records
+from search import SearchIndex
+import blobs
+from packs import PackStore
+from blobs import BlobStore
+from indexes import FieldIndex, UuidIndex, UuidFile, SortedIndex, Aggregates, cross_counts
+from util import atomic_file, sync_dir
+from locking import LockFile
+import instrument, vcs, query
 
 logger = logging.getLogger(__name__)
 
@@ -11,12 +20,88 @@ def timestamp():
 
 def load_data(filename, **kwargs):
     try:
-        return json.load(open(filename, 'r'), **kwargs)
+        with open(filename, 'rb') as f:
+            if instrument.enabled:
+                instrument.count('files read')
+                instrument.count('bytes read', os.fstat(f.fileno()).st_size)
+            if f.read(len(columnar.MAGIC)) == columnar.MAGIC:
+                return columnar.ColumnarData(filename)
+            f.seek(0)
+            with instrument.timer('parse ' + os.path.basename(filename)):
+                return json.load(f, **kwargs)
     except IOError:
         return {}
     
+def data_format(filename):
+    '''
+    Returns 'columnar' or 'json' depending on the file contents or None if it doesn't exist.
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            return 'columnar' if f.read(len(columnar.MAGIC)) == columnar.MAGIC else 'json'
+    except IOError:
+        return None
+    
 def save_data(filename, data, **kwargs):
-    json.dump(data, open(filename, 'w'), indent=0)
+    with instrument.timer('save ' + os.path.basename(filename)):
+        with atomic_file(filename) as f:
+            json.dump(data, f, indent=0)
+            if instrument.enabled:
+                instrument.count('files written')
+                instrument.count('bytes written', f.tell())
+
+def load_settings(directory):
+    '''
+    The default settings updated by the tracker's conf.py, if it has one.
+    
+    The compiled conf.py is cached in .conf.cache, keyed on its inode, mtime
+    and size, so it is only parsed again when it changes, including when
+    it's replaced by a file of the same size within the mtime resolution.
+    '''
+    settings = conf.__dict__.copy()
+    filename = "{0}/conf.py".format(directory)
+    try:
+        s = os.stat(filename)
+    except OSError:
+        logger.debug("No custom settings")
+        return settings
+    
+    stamp = [imp.get_magic(), s.st_ino, s.st_mtime, s.st_size]
+    cache = "{0}/.conf.cache".format(directory)
+    code = None
+    try:
+        with open(cache, 'rb') as f:
+            if marshal.load(f) == stamp:
+                code = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    
+    if code is None:
+        with open(filename, 'rU') as f:
+            code = compile(f.read(), filename, 'exec')
+        try:
+            with atomic_file(cache, 'wb') as f:
+                marshal.dump(stamp, f)
+                marshal.dump(code, f)
+        except (IOError, OSError):
+            logger.debug("Unable to cache settings")
+    
+    exec code in settings
+    logger.debug("Loaded custom settings")
+    return settings
+
+def read_row(args):
+    '''
+    Parse an object file straight to (uuid, status, index row, text).
+    Takes a single tuple so it can be used with a process pool.
+    '''
+    path, directory, fields, required, index, serializer = args
+    with open(path, 'rb') as bob:
+        return parse_row(bob.read(), directory, fields, required, index, serializer)
+
+def parse_row(data, directory, fields, required, index, serializer='json'):
+    issue = Issue(directory, fields, required, **serializers.loads(data, serializer))
+    return issue.uuid, issue.status, issue.index(index), issue.text()
         
 class PyIssues(object):
     '''
@@ -24,74 +109,736 @@ class PyIssues(object):
     '''
     def __init__(self, directory):
         self.directory = directory
-        self.settings = conf.__dict__.copy()
-        
-        # load local settings
-        try:
-            execfile("{0}/conf.py".format(self.directory), self.settings)
-            logger.debug("Loaded custom settings")
-        except IOError:
-            logger.debug("No custom settings")
+        self.settings = load_settings(directory)
         
         self.obj_dir = "{0}/objs".format(self.directory)
         if not os.path.isdir(self.obj_dir):
             os.makedirs(self.obj_dir)
         
         self.issues_file = "{0}/issues.db".format(directory)
-        self.issues_data = load_data(self.issues_file)
+        self._issues_data = None
+        self._delta = {}
         self.dirty = False
+        
+        self.storage = data_format(self.issues_file) or self.settings['_storage']
+        self.serializer = serializers.Store(self.settings['_serializer'])
+        self.row_class = records.row_class(self.settings['_index'])
+        
+        self._field_index = None
+        self._uuid_index = None
+        
+        self._sorted_index = None
+        
+        self.stats_file = "{0}/stats.db".format(directory)
+        self._aggregates = None
+        
+        self.uuids_file = "{0}/uuids.db".format(directory)
+        
+        self.manifest_file = "{0}/manifest.db".format(directory)
+        self._manifest = None
+        
+        self.search_index = SearchIndex("{0}/search".format(directory))
+        
+        self.packs = PackStore("{0}/packs".format(directory))
+        
+        self.blobs = BlobStore("{0}/files/blobs".format(directory))
+        
+        self.lock = LockFile("{0}/.lock".format(directory))
+        
+        # stamp of issues.db when it was loaded, so flush can tell if
+        # another process has written it since
+        self._loaded = None
+        self._rebuilt = False
+        
+        self.journal_file = "{0}/journal".format(directory)
+        self._journal = None
+        self._checkpointed = False
+        self._pending = {}
+        self._released = []
+        self.git_file = "{0}/git.db".format(directory)
+        self._git_head = None
+        
+        if os.path.exists(self.journal_file):
+            with self.lock.database():
+                if os.path.exists(self.journal_file):
+                    self._replay()
+        
+        if self.settings['_git_refresh']:
+            self._git_refresh()
+    
+    @property
+    def issues_data(self):
+        '''
+        The index rows, loaded on first access with any pending changes applied.
+        '''
+        if self._issues_data is None:
+            logger.debug("Loading database")
+            self._loaded = self._source_stamp()
+            with instrument.timer('load database'):
+                self._issues_data = load_data(self.issues_file)
+            # saved counts are kept up to date along with the rows
+            self._aggregates = self._load_aggregates(self._loaded)
+            for uuid, row in self._delta.items():
+                if row is None:
+                    self._drop_row(uuid)
+                else:
+                    self._put_row(uuid, row)
+        return self._issues_data
+    
+    @issues_data.setter
+    def issues_data(self, value):
+        self._issues_data = value
+    
+    def _source_stamp(self):
+        '''
+        Size, mtime and inode of the issues file so we can tell if an index
+        is stale.  Every save renames a new file into place so the inode
+        changes even when a write of the same size lands in the same tick.
+        '''
+        try:
+            s = os.stat(self.issues_file)
+            return [s.st_size, s.st_mtime, s.st_ino]
+        except OSError:
+            return None
+    
+    @property
+    def field_index(self):
+        '''
+        Inverted index for the fields in _indexed, built from issues_data on
+        first use and then kept up to date as rows change.  It isn't saved,
+        as building it is about as quick as loading it and nearly every
+        flush would have to rewrite it.
+        '''
+        if self._field_index is None:
+            with instrument.timer('build field index'):
+                self._field_index = FieldIndex.build(self.settings['_index'], self.settings['_indexed'], self.issues_data)
+        return self._field_index
+    
+    @property
+    def sorted_index(self):
+        '''
+        Orderings for the fields in _sorted.  Like field_index they aren't
+        saved, each is sorted from issues_data the first time it is read.
+        '''
+        if self._sorted_index is None:
+            self._sorted_index = dict((f, SortedIndex.build(self.settings['_index'], f, self.issues_data)) for f in self.settings['_sorted'])
+        return self._sorted_index
+    
+    @property
+    def aggregates(self):
+        '''
+        Counts for the groups in _aggregates and each field in _indexed.
+        
+        They are saved in stats.db with the stamp of the database they
+        count, loaded along with the database and kept up to date as rows
+        change.  Until the database is needed the saved counts are used
+        as they are, so stats doesn't have to load it.  If they are out
+        of date they are counted again and saved.
+        '''
+        if self._aggregates is None:
+            if self._issues_data is None and not self._delta:
+                saved = self._load_aggregates(self._source_stamp())
+                if saved is not None:
+                    return saved
+            
+            self.issues_data
+            if self._aggregates is None:
+                logger.debug("Counting aggregates")
+                self._aggregates = Aggregates.build(self.row_class._fields[1:], self._aggregate_groups(),
+                                                    self.issues_data, self.field_index)
+                if not self._delta:
+                    # save them now if they count what is on disk, as a
+                    # flush only happens if something changes
+                    with self.lock.database():
+                        if self._loaded is not None and self._source_stamp() == self._loaded:
+                            save_data(self.stats_file, {'source': self._loaded, 'groups': self._aggregates.dump()})
+        return self._aggregates
+    
+    def _aggregate_groups(self):
+        groups = [ tuple(x) for x in self.settings['_aggregates'] ]
+        return groups + [ (f, ) for f in self.settings['_indexed'] if not (f, ) in groups ]
+    
+    def _load_aggregates(self, source):
+        '''
+        The counts saved in stats.db if they were saved with the database
+        stamped source, otherwise None.
+        '''
+        data = load_data(self.stats_file)
+        groups = self._aggregate_groups()
+        if source is None or data.get('source') != source or [ tuple(x[0]) for x in data.get('groups', []) ] != groups:
+            return None
+        aggregates = Aggregates(self.row_class._fields[1:], groups)
+        aggregates.load(data['groups'])
+        return aggregates
+    
+    @property
+    def uuid_index(self):
+        '''
+        Sorted uuids from issues_data for resolving stubs.
+        '''
+        if self._uuid_index is None:
+            self._uuid_index = UuidIndex(self.issues_data)
+        return self._uuid_index
     
+    @instrument.timed('flush')
     def flush(self):
         '''
         Writes out database if necessary.
         Returns whether the database was written or not
+        
+        If another process has written the database since it was loaded
+        it is reloaded and our changes merged in, rather than overwriting
+        theirs.  The whole save is done holding the database lock.
         '''
-        if self.issues_data and self.dirty:
+        if self._journal is not None:
+            logger.debug("Transaction in progress - not saving")
+            return False
+        
+        if not self.dirty:
+            return False
+        
+        with self.lock.database():
+            if self._issues_data is not None and not self._rebuilt and self._loaded != self._source_stamp():
+                logger.debug("Database changed on disk - merging {0} changes".format(len(self._delta)))
+                self._unload()
+            
+            if not self.issues_data:
+                return False
+            
             logger.debug("Saving database...")
-            save_data(self.issues_file, self.issues_data)
+            if self.storage == 'columnar':
+                columnar.save(self.issues_file, self.issues_data, self.settings['_index'] + ('comments', 'attachments'))
+            else:
+                save_data(self.issues_file, dict(self.issues_data.iteritems()))
+            source = self._source_stamp()
+            if self._aggregates is not None:
+                save_data(self.stats_file, {'source': source, 'groups': self._aggregates.dump()})
+            with instrument.timer('save uuids.db'):
+                UuidFile.save(self.uuids_file, self.uuid_index.uuids, source)
+            if self._manifest is not None:
+                save_data(self.manifest_file, self._manifest)
+                self._manifest = None
+            if self.search_index.dirty:
+                with instrument.timer('save search'):
+                    self.search_index.save()
+            if self._git_head is not None:
+                save_data(self.git_file, {'head': self._git_head})
+                self._git_head = None
+            self._loaded = source
+            self._rebuilt = False
+            self._delta = {}
             self.dirty = False
             return True
-        return False
+    
+    @instrument.timed('git refresh')
+    def _git_refresh(self):
+        '''
+        If the tracker is in a git repository and HEAD has moved since the
+        database was saved (e.g. a pull or checkout), reapply just the
+        object files that changed between the two commits.
+        '''
+        git_dir = vcs.find_git_dir(self.directory)
+        if git_dir is None:
+            return
+        
+        head = vcs.head(git_dir)
+        old = load_data(self.git_file).get('head')
+        if head is None or old == head or not os.path.exists(self.issues_file):
+            return
+        
+        if old is None:
+            # assume the database matches what is checked out
+            save_data(self.git_file, {'head': head})
+            return
+        
+        try:
+            changes = vcs.changed(self.obj_dir, old, head)
+        except vcs.GitError as e:
+            logger.warning("Unable to find changes since {0}, you may need to rebuild: {1}".format(old[:8], e))
+            return
+        
+        logger.debug("Applying {0} changes from {1} to {2}".format(len(changes), old[:8], head[:8]))
+        rows = []
+        for status, name in changes:
+            path = '{0}/{1}'.format(self.obj_dir, name)
+            if os.path.exists(path):
+                rows.append(read_row((path, self.directory, self.settings['_fields'], self.settings['_required'],
+                                      self.settings['_index'], self.serializer.default)))
+            elif name in self.packs:
+                rows.append(parse_row(self.packs.get(name), self.directory, self.settings['_fields'],
+                                      self.settings['_required'], self.settings['_index'], self.serializer.default))
+            elif name in self.issues_data:
+                self._record(name, None)
+                self.search_index.remove(name)
+        
+        for uuid, status, row, text in rows:
+            if status != 'archived':
+                self._record(uuid, row)
+                self.search_index.add(uuid, text)
+            elif uuid in self.issues_data:
+                self._record(uuid, None)
+                self.search_index.remove(uuid)
+        
+        if self.dirty:
+            # saved by the flush that writes these changes to the index
+            self._git_head = head
+        else:
+            save_data(self.git_file, {'head': head})
+    
+    def git_committed(self):
+        '''
+        Note that the object files have just been committed.  The database
+        already matches them, so the new HEAD is recorded rather than its
+        changes being applied again the next time the tracker is opened.
+        '''
+        git_dir = vcs.find_git_dir(self.directory)
+        head = vcs.head(git_dir) if git_dir is not None else None
+        if head is None:
+            return
+        if self.dirty:
+            self._git_head = head
+        else:
+            save_data(self.git_file, {'head': head})
+    
+    def convert(self, storage):
+        '''
+        Switch the database between 'json' and 'columnar' storage.
+        '''
+        if not storage in ('json', 'columnar'):
+            raise PyIssuesException("Unknown storage format: {0}".format(storage))
+        
+        self.storage = storage
+        self.dirty = True
+        return self.flush()
     
     def close(self):
         '''
         Saves the database if necessary and cleans up.
         '''
         self.flush()
+        self._unload()
+        self.lock.close()
+    
+    def _unload(self):
+        if hasattr(self._issues_data, 'close'):
+            self._issues_data.close()
         self.issues_data = None
+        self._field_index = None
+        self._uuid_index = None
+        self._sorted_index = None
+        self._aggregates = None
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Batch updates and deletes so object files and the database are
+        written once, when the block exits.
+        
+            with issues.transaction():
+                for issue in ...:
+                    issues.update(issue)
+        
+        Changes are appended to a journal which is committed before being
+        applied, so an interrupted commit is finished the next time the
+        tracker is opened.  If the block raises nothing is written, apart
+        from anything already committed by checkpoint.
+        '''
+        if self._journal is not None:
+            yield self
+            return
+        
+        # the journal is shared so only one process at a time can use it
+        with self.lock.database():
+            delta = dict(self._delta)
+            search = self.search_index.pending()
+            self._journal = open(self.journal_file, 'w')
+            self._checkpointed = False
+            try:
+                yield self
+            except:
+                self._journal.close()
+                self._journal = None
+                self._pending = {}
+                self._released = []
+                self._delta = delta
+                self._unload()
+                self.search_index.restore(search)
+                if self._checkpointed:
+                    # finish what was committed, dropping the rest
+                    self._replay()
+                else:
+                    os.unlink(self.journal_file)
+                raise
+            
+            self._mark()
+            self._journal.close()
+            self._journal = None
             
-    def filter(self, filters=None, sort=None):
+            self._commit()
+    
+    def checkpoint(self):
+        '''
+        Commit the changes made so far in a transaction and write their
+        object files, leaving the database to be saved once when the
+        transaction ends.  An interrupted transaction is replayed up to
+        its last checkpoint.
+        '''
+        if self._journal is None:
+            raise PyIssuesException("No transaction in progress")
+        self._mark()
+        self._checkpointed = True
+        self._write_pending()
+    
+    def _mark(self):
         '''
-        Returns index items matching the criteria.
+        Append a commit marker to the journal and make it durable.
+        '''
+        self._journal.write(json.dumps({'commit': True}) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        sync_dir(self.directory)
+    
+    def _commit(self):
+        '''
+        Write out pending object files and the database then clear the journal.
+        '''
+        self._write_pending()
+        self.flush()
+        os.unlink(self.journal_file)
+    
+    def _write_pending(self):
+        logger.debug("Committing {0} changes".format(len(self._pending)))
+        for uuid, data in self._pending.items():
+            if data is None:
+                self._remove_object(uuid)
+            else:
+                with self.lock.object(uuid):
+                    with atomic_file('{0}/{1}'.format(self.obj_dir, uuid), 'wb') as bob:
+                        bob.write(data)
+                self._unpack(uuid)
+        self._pending = {}
         
-        filters can be a func or a dict of exact matches.
-        sort is the name of a field, optionally prefixed with '-' for reverse.
+        for issue in self._released:
+            issue.release_files()
+        self._released = []
+    
+    def _replay(self):
+        '''
+        Apply a journal left over by an interrupted transaction, up to its
+        last commit marker.
+        Entries are whole issues, or None for deletes, so replaying a commit
+        that had already been applied before it was interrupted is harmless.
         '''
-        items = [ Issue.expand_index(x, self.issues_data[x], self.settings['_index']) for x in self.issues_data ]
+        entries = {}
+        committed = None
+        with open(self.journal_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if entry.get('commit'):
+                    committed = dict(entries)
+                    continue
+                entries[entry['uuid']] = entry['data']
         
-        if filters:
-            if hasattr(filters, '__iter__'):
-                d = filters
-                filters = lambda x: { i: x.get(i) for i in d } == d
+        if committed is None:
+            logger.warning("Discarding uncommitted journal")
+            os.unlink(self.journal_file)
+            return
+        
+        entries = committed
+        logger.info("Replaying journal ({0} changes)".format(len(entries)))
+        for uuid, data in entries.items():
+            if data is None:
+                self._record(uuid, None)
+                self.search_index.remove(uuid)
+                self._pending[uuid] = None
+            else:
+                issue = self.create(**data)
+                self._record(uuid, issue.index(self.settings['_index']))
+                self.search_index.add(uuid, issue.text())
+                self._pending[uuid] = self.serializer.dumps(issue.as_dict())
+        self._commit()
             
-            items = [ x for x in items if filters(x) ]
+    @instrument.timed('filter')
+    def filter(self, filters=None, sort=None, limit=None, offset=0, iterator=False):
+        '''
+        Returns index rows matching the criteria.  Rows are read only tuples
+        with dict style access, use as_dict() for a copy to change or pass
+        to json.dumps.
+        
+        filters can be a func, a dict of exact matches or a query string
+        e.g. 'priority in (high, blocker) and created >= 2013-01-01', see
+        pyissues.query.  Dict filters on fields in _indexed are resolved
+        from the field index and queries narrowed with the indexes before
+        their compiled predicate is run on the remaining rows.
+        
+        sort is a comma separated list of fields, each optionally prefixed
+        with '-' for reverse e.g. '-priority,created'.  Fields in _ranked
+        sort in the order of their options in the settings.
+        
+        limit and offset select a page of the results.  With a limit only
+        the top offset + limit items are selected rather than sorting
+        everything, and a sort on a field in _sorted walks the presorted
+        index unless the filters leave few enough rows to sort directly.
+        
+        iterator returns a generator instead of a list.
+        '''
+        uuids = self.issues_data
+        test = None
+        
+        keys = self._sort_spec(sort)
+        stop = None if limit is None else offset + limit
+        walk = limit is not None and len(keys) == 1 and keys[0][0] in self.settings['_sorted'] \
+            and not keys[0][0] in self.settings['_ranked']
+        
+        if isinstance(filters, basestring):
+            filters = query.parse(filters)
+        
+        if isinstance(filters, query.Query):
+            with instrument.timer('query plan'):
+                test = filters.predicate(self.settings['_index'], self.settings)
+                candidates = filters.candidates(self.field_index, self.sorted_index, self.settings, self.issues_data)
+            if candidates is not None:
+                uuids = candidates
+            filters = None
+        
+        if filters and hasattr(filters, '__iter__'):
+            candidates, filters = self.field_index.candidates(filters)
+            
+            if 'uuid' in filters:
+                uuid = filters.pop('uuid')
+                candidates = set([uuid]) if uuid in self.issues_data and (candidates is None or uuid in candidates) else set()
+            
+            if candidates is not None:
+                uuids = candidates
+        
+        if filters and hasattr(filters, '__iter__'):
+            d = filters
+            filters = lambda x: { i: x.get(i) for i in d } == d
+        
+        if walk and (uuids is self.issues_data or self._walkable(len(uuids), stop)):
+            ordered = self.sorted_index[keys[0][0]].uuids(keys[0][1])
+            if uuids is self.issues_data:
+                uuids = ordered
+            else:
+                candidates = uuids
+                uuids = ( x for x in ordered if x in candidates )
+            keys = None
+        
+        row, data = self.row_class, self.issues_data
+        if test is not None:
+            uuids = ( x for x in uuids if test(x, data[x]) )
+        
+        # function filters need whole rows, otherwise rows are only built
+        # for the results and sorting just reads the sorted fields
+        rows = None if filters else data
+        items = itertools.ifilter(filters, ( row(x, *data[x]) for x in uuids )) if filters else uuids
+        
+        if keys:
+            with instrument.timer('sort'):
+                if len(set(x[1] for x in keys)) == 1:
+                    key = self._sort_key([ x[0] for x in keys ], rows=rows)
+                    reverse = keys[0][1]
+                    if stop is not None:
+                        items = (heapq.nlargest if reverse else heapq.nsmallest)(stop, items, key=key)
+                    else:
+                        items = sorted(items, key=key, reverse=reverse)
+                else:
+                    key = self._sort_key([ x[0] for x in keys ], [ x[1] for x in keys ], rows=rows)
+                    items = heapq.nsmallest(stop, items, key=key) if stop is not None else sorted(items, key=key)
+        
+        if offset or stop is not None:
+            items = itertools.islice(items, offset, stop)
+        
+        if rows is not None:
+            items = ( row(x, *data[x]) for x in items )
+            
+        return iter(items) if iterator else list(items)
+    
+    def _walkable(self, count, stop):
+        '''
+        Whether walking the presorted index for the first stop of count
+        candidates beats sorting them.  The walk passes about
+        stop * total / count rows to find them, sorting looks at all count.
+        '''
+        return count * count > stop * len(self.issues_data)
+    
+    def _sort_spec(self, sort):
+        '''
+        Parse '-priority,created' into [('priority', True), ('created', False)].
+        '''
+        keys = []
+        for field in (sort or '').split(','):
+            field = field.strip()
+            if field:
+                keys.append((field[1:], True) if field[0] == '-' else (field, False))
+        return keys
+    
+    def _sort_key(self, fields, reverse=None, rows=None):
+        '''
+        Key function for sorting rows on several fields.
+        Fields in reverse are wrapped so they sort in the opposite direction.
         
-        if sort:
-            reverse = False
-            if sort[0] == '-':
-                sort = sort[1:]
-                reverse = True
-            items = sorted(items, key=lambda x: x[sort], reverse=reverse)
+        With rows the key takes a uuid and reads just the sorted fields
+        from rows, a dict of uuid -> raw row like issues_data.
+        '''
+        getters = []
+        for i, field in enumerate(fields):
+            position = self.row_class._positions[field]
+            options = self.settings.get(field)
+            
+            if rows is None:
+                getter = operator.itemgetter(position)
+            elif position == 0:
+                getter = lambda u: u
+            else:
+                getter = lambda u, p=position - 1: rows[u][p]
             
+            if field in self.settings['_ranked'] and isinstance(options, tuple):
+                rank = dict((x, n) for n, x in enumerate(options))
+                def getter(r, g=getter, rank=rank):
+                    v = g(r)
+                    return (rank.get(v, len(rank)), v)
+            
+            if reverse and reverse[i]:
+                getter = lambda r, g=getter: Descending(g(r))
+            getters.append(getter)
+        
+        if len(getters) == 1:
+            return getters[0]
+        return lambda r: tuple(g(r) for g in getters)
+    
+    @instrument.timed('pack')
+    def pack(self, days=None):
+        '''
+        Move archived issues, and closed issues not updated for days
+        (default _pack_days), out of objs into a new compressed pack.
+        They can still be found by get and match and are read by rebuild.
+        
+        Returns the number of issues packed.
+        '''
+        if self._journal is not None:
+            raise PyIssuesException("Can't pack during a transaction")
+        
+        days = self.settings['_pack_days'] if days is None else days
+        cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=days)).strftime(DATETIME_FORMAT)
+        
+        # anything not in the index has been archived
+        candidates = self.field_index.lookup('status', 'closed') | self.field_index.lookup('status', 'archived')
+        items = []
+        for name in os.listdir(self.obj_dir):
+            if name.startswith('.') or (name in self.issues_data and not name in candidates):
+                continue
+            with open('{0}/{1}'.format(self.obj_dir, name), 'rb') as bob:
+                data = bob.read()
+            issue = self.serializer.loads(data)
+            if issue.get('status') == 'archived' or (issue.get('status') == 'closed' and (issue.get('updated') or '') <= cutoff):
+                items.append((name, data))
+        
+        if not items:
+            return 0
+        
+        with self.lock.database():
+            self.packs.add(items)
+            for name, data in items:
+                path = '{0}/{1}'.format(self.obj_dir, name)
+                with self.lock.object(name):
+                    # if it has been updated since the loose copy wins, so leave it
+                    with open(path, 'rb') as bob:
+                        if bob.read() == data:
+                            os.unlink(path)
+        logger.debug("Packed {0} issues".format(len(items)))
+        return len(items)
+    
+    @instrument.timed('stats')
+    def stats(self, *fields):
+        '''
+        Count issues grouped by one or more index fields.
+        
+        Returns {value: count}, or {(value, value, ...): count} for several
+        fields.  Groups in _aggregates and single fields in _indexed are
+        answered from the saved counts, other groups of _indexed fields
+        from the field index and anything else means a scan of the database.
+        '''
+        if not fields:
+            raise PyIssuesException("No fields to group by")
+        for f in fields:
+            if not f in self.row_class._positions or f == 'uuid':
+                raise PyIssuesException("Not an index field: {0}".format(f))
+        
+        counts = self.aggregates.lookup(fields)
+        if counts is not None:
+            return counts
+        
+        if all(f in self.settings['_indexed'] for f in fields):
+            return cross_counts(self.field_index, fields)
+        
+        logger.debug("No aggregate for {0} - scanning".format(', '.join(fields)))
+        # the stored rows don't include the uuid
+        positions = [ self.row_class._positions[f] - 1 for f in fields ]
+        counts = {}
+        for row in self.issues_data.itervalues():
+            key = tuple(row[i] for i in positions) if len(positions) > 1 else row[positions[0]]
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+    
+    def row(self, uuid):
+        '''
+        Index row for a single issue.
+        '''
+        return self.row_class(uuid, *self.issues_data[uuid])
+    
+    @instrument.timed('search')
+    def search(self, query, limit=None):
+        '''
+        Full text search of description, body and comments.
+        
+        Words must all match, "quoted phrases" must appear in order and a
+        trailing * matches any word with that prefix.  Returns (index row,
+        score) pairs, best match first.
+        '''
+        items = []
+        for uuid, score in self.search_index.search(query):
+            if uuid in self.issues_data:
+                items.append((self.row(uuid), score))
+                if len(items) == limit:
+                    break
         return items
     
+    @instrument.timed('match')
     def match(self, uuid):
         '''
         Match a single file from a uuid stub so we dont have to type full uuids.
         Returns the full file path or throws an error if none or multiple matches.
+        
+        Stubs are resolved against the uuid index, only falling back to
+        listing the objects directory if the index has no usable entry
+        (e.g. archived issues or an out of date database).  Packs are
+        searched along with either.
         '''
+        matches = self._match_index(uuid)
+        if matches:
+            # packs also hold archived issues, which aren't in the index
+            matches = sorted(set(matches) | set(self.packs.matches(uuid)))
+        
+        if len(matches) > 1:
+            raise PyIssuesException("Multiple matches for {0} - be more specific".format(uuid))
+        
+        if matches:
+            path = '{0}/{1}'.format(self.obj_dir, matches[0])
+            if os.path.exists(path) or matches[0] in self._pending or matches[0] in self.packs:
+                return path
+            logger.debug("Stale index entry for {0}".format(matches[0]))
+        
         import glob
-        matches = glob.glob('{0}/{1}*'.format(self.obj_dir, uuid))
+        with instrument.timer('match glob'):
+            names = set(os.path.basename(x) for x in glob.glob('{0}/{1}*'.format(self.obj_dir, uuid)))
+        
+        # the same issue can be loose and packed, so look at both together
+        names.update(self.packs.matches(uuid))
+        matches = [ '{0}/{1}'.format(self.obj_dir, x) for x in sorted(names) ]
         
         if not matches:
             raise PyIssuesException("No match for uuid: {0}".format(uuid))
@@ -101,13 +848,53 @@ class PyIssues(object):
         
         return matches[0]
     
+    def _match_index(self, stub):
+        '''
+        Resolve a stub from the loaded index or, if the database hasn't been
+        loaded yet, from the sorted uuid file plus any pending changes.
+        '''
+        if self._issues_data is None:
+            try:
+                uuids = UuidFile(self.uuids_file)
+            except (IOError, ValueError):
+                uuids = None
+            
+            if uuids is not None and uuids.header.get('source') == self._source_stamp():
+                matches = [ x for x in uuids.matches(stub, 2 + len(self._delta)) if not x in self._delta ]
+                matches += [ x for x in self._delta if x.startswith(stub) and self._delta[x] is not None ]
+                return sorted(matches)[:2]
+            
+        return self.uuid_index.matches(stub)
+    
+    @instrument.timed('get')
     def get(self, uuid):
         '''
         Get a single issue.
         uuid can be a partial uuid.
         '''
-        with open(self.match(uuid)) as bob:
-            data = json.load(bob)
+        return self._load(self.match(uuid))
+    
+    def _load(self, path):
+        if instrument.enabled:
+            instrument.count('objects parsed')
+        name = os.path.basename(path)
+        if name in self._pending:
+            if self._pending[name] is None:
+                raise PyIssuesException("No match for uuid: {0}".format(name))
+            data = self.serializer.loads(self._pending[name])
+        else:
+            try:
+                with open(path, 'rb') as bob:
+                    data = bob.read()
+                if instrument.enabled:
+                    instrument.count('files read')
+                    instrument.count('bytes read', len(data))
+                data = self.serializer.loads(data)
+            except IOError:
+                data = self.packs.get(name)
+                if data is None:
+                    raise
+                data = self.serializer.loads(data)
             
         return self.create(**data)
     
@@ -116,35 +903,302 @@ class PyIssues(object):
     
     def delete(self, uuid):
         f = self.match(uuid)
-        issue = self.get(uuid)
+        issue = self._load(f)
+        
+        self._record(issue.uuid, None)
+        self.search_index.remove(issue.uuid)
+        if self._journal is not None:
+            self._journal.write(json.dumps({'uuid': issue.uuid, 'data': None}) + '\n')
+            self._pending[issue.uuid] = None
+            self._released.append(issue)
+        else:
+            self._remove_object(issue.uuid)
+            issue.release_files()
+    
+    def _remove_object(self, uuid):
+        '''
+        Remove the object file for uuid, and any packed copies.
+        '''
+        path = '{0}/{1}'.format(self.obj_dir, uuid)
+        with self.lock.object(uuid):
+            if os.path.exists(path):
+                os.unlink(path)
+        self._unpack(uuid)
+    
+    @instrument.timed('prune')
+    def prune_files(self):
+        '''
+        Remove stored attachments that no issue, loose or packed, has
+        attached any more.  Every object file is read to find the ones
+        still in use.
+        Returns the number of files removed.
+        '''
+        if self._journal is not None:
+            raise PyIssuesException("Can't prune during a transaction")
         
-        del self.issues_data[issue.uuid]
-        os.unlink(f)
+        started = time.time()
+        live = set()
+        for issue in self.iter_issues():
+            for attachment in issue.attachments:
+                if attachment[1].startswith(blobs.PREFIX):
+                    live.add(attachment[1][len(blobs.PREFIX):])
         
-        self.dirty = True
+        with self.lock.database():
+            removed = self.blobs.prune(live, started)
+        logger.debug("Pruned {0} files".format(len(removed)))
+        return len(removed)
+    
+    def _unpack(self, uuid):
+        '''
+        Drop any packed copies of uuid, once its loose object is written
+        or removed, so a stale copy can't turn up again.
+        '''
+        if uuid in self.packs:
+            with self.lock.database():
+                self.packs.remove(uuid)
     
-    def update(self, issue):
-        issue.updated = timestamp()
+    @instrument.timed('update')
+    def update(self, issue, touch=True):
+        '''
+        Save an issue and update its index entry.
+        Set touch to False to keep an existing updated timestamp.
+        '''
+        if self._stage(issue, touch):
+            self._write_object(issue)
+    
+    def _stage(self, issue, touch=True):
+        '''
+        Update the index entry for an issue.
+        Returns whether the object file still needs writing, which it
+        doesn't during a transaction.
+        '''
+        if touch or issue.updated is None:
+            issue.updated = timestamp()
         
-        self.issues_data[issue.uuid] = issue.index(self.settings['_index'])
+        self._record(issue.uuid, issue.index(self.settings['_index']))
+        self.search_index.add(issue.uuid, issue.text())
         
-        with open('{0}/{1}'.format(self.obj_dir, issue.uuid), 'w') as bob:
-            issue.write(bob)
-            
-        self.dirty = True
+        if self._journal is not None:
+            self._journal.write(json.dumps({'uuid': issue.uuid, 'data': issue.as_dict()}) + '\n')
+            self._pending[issue.uuid] = self.serializer.dumps(issue.as_dict())
+            return False
+        return True
+    
+    def _write_object(self, issue):
+        data = self.serializer.dumps(issue.as_dict())
+        if instrument.enabled:
+            instrument.count('files written')
+            instrument.count('bytes written', len(data))
+        with self.lock.object(issue.uuid):
+            with atomic_file('{0}/{1}'.format(self.obj_dir, issue.uuid), 'wb') as bob:
+                bob.write(data)
+        self._unpack(issue.uuid)
+    
+    def iter_issues(self, filters=None):
+        '''
+        Generator of issues, either those matching filters or every object
+        file (including archived issues) if no filters are given.
+        '''
+        if filters is None:
+            loose = set( x for x in os.listdir(self.obj_dir) if not x.startswith('.') )
+            names = itertools.chain(loose, ( x for x, _ in self.packs.entries() if not x in loose ))
+            paths = ( '{0}/{1}'.format(self.obj_dir, x) for x in names )
+        else:
+            paths = ( '{0}/{1}'.format(self.obj_dir, x['uuid']) for x in self.filter(filters) )
+        
+        for path in paths:
+            yield self._load(path)
+    
+    def export_issues(self, stream, format='jsonl', filters=None):
+        '''
+        Stream issues to a file like object.
+        
+        jsonl writes one full issue per line, csv writes the index fields.
+        Returns the number of issues written.
+        '''
+        import transfer
+        if format == 'jsonl':
+            return transfer.write_jsonl(stream, ( x.as_dict() for x in self.iter_issues(filters) ))
+        if format == 'csv':
+            return transfer.write_csv(stream, self.filter(filters), ('uuid', ) + self.settings['_index'])
+        raise PyIssuesException("Unknown format: {0}".format(format))
+    
+    def import_issues(self, stream, format='jsonl', batch_size=1000):
+        '''
+        Load issues from a file like object, as written by export_issues.
+        
+        The import is a single transaction with a checkpoint after each
+        batch, so the objects are written a batch at a time and the
+        database saved once at the end.  Attachments are not copied.
+        Returns the number of issues imported.
+        '''
+        import transfer
+        if format == 'jsonl':
+            items = transfer.read_jsonl(stream)
+        elif format == 'csv':
+            fields = set(x[0] for x in self.settings['_fields'])
+            items = ( dict((k, v) for k, v in x.items() if k in fields and v != '') for x in transfer.read_csv(stream) )
+        else:
+            raise PyIssuesException("Unknown format: {0}".format(format))
         
-    def rebuild(self):
-        self.issues_data = {}
-        self.dirty = True
         c = 0
-        for uuid in os.listdir(self.obj_dir):
-            issue = self.get(uuid)
-            if issue.status != 'archived':
-                self.issues_data[issue.uuid] = issue.index(self.settings['_index'])
-            c += 1
+        with self.transaction():
+            for batch in transfer.batches(items, batch_size):
+                for data in batch:
+                    self.update(self.create(**data), touch=False)
+                self.checkpoint()
+                c += len(batch)
+                logger.debug("Imported {0} issues".format(c))
         return c
+    
+    def _record(self, uuid, row):
+        '''
+        Note a changed (or deleted if row is None) index row.
+        Only applied straight away if the database is already loaded,
+        otherwise it gets merged in when it is loaded or flushed.
+        '''
+        self._delta[uuid] = row
+        if self._issues_data is not None:
+            if row is None:
+                self._drop_row(uuid)
+            else:
+                self._put_row(uuid, row)
+        self.dirty = True
+    
+    def _put_row(self, uuid, row):
+        '''
+        Add or replace an index row, keeping the secondary indexes in step.
+        '''
+        old = self.issues_data.get(uuid)
+        if old is not None:
+            if self._field_index is not None:
+                self._field_index.remove(uuid, old)
+            for index in self.sorted_index.values():
+                index.remove(uuid, old)
+            if self._aggregates is not None:
+                self._aggregates.remove(uuid, old)
+        if self._field_index is not None:
+            self._field_index.add(uuid, row)
+        for index in self.sorted_index.values():
+            index.add(uuid, row)
+        if self._aggregates is not None:
+            self._aggregates.add(uuid, row)
+        self.uuid_index.add(uuid)
+        self.issues_data[uuid] = row
+        self.dirty = True
+    
+    def _drop_row(self, uuid):
+        old = self.issues_data.pop(uuid, None)
+        if old is not None:
+            if self._field_index is not None:
+                self._field_index.remove(uuid, old)
+            for index in self.sorted_index.values():
+                index.remove(uuid, old)
+            if self._aggregates is not None:
+                self._aggregates.remove(uuid, old)
+            self.uuid_index.remove(uuid)
+            self.dirty = True
+        
+    @instrument.timed('rebuild')
+    def rebuild(self, incremental=False, jobs=None):
+        '''
+        Rebuild the database from the object files.
+        
+        With incremental only files whose mtime or size differ from the
+        manifest recorded by the last rebuild are parsed.  jobs > 1 parses
+        files across a process pool.
+        
+        Returns the number of files parsed.
+        '''
+        manifest = load_data(self.manifest_file) if incremental else {}
+        
+        if manifest and not self.issues_data:
+            logger.debug("Database missing - doing a full rebuild")
+            manifest = {}
+        
+        if not manifest:
+            self.issues_data = {}
+            self._field_index = FieldIndex(self.settings['_index'], self.settings['_indexed'])
+            self._uuid_index = UuidIndex()
+            self._sorted_index = dict((f, SortedIndex(self.settings['_index'], f)) for f in self.settings['_sorted'])
+            self._aggregates = None
+            self.search_index.clear()
+        
+        current = {}
+        changed = []
+        for name in os.listdir(self.obj_dir):
+            if name.startswith('.'):
+                continue
+            s = os.stat('{0}/{1}'.format(self.obj_dir, name))
+            current[name] = [s.st_mtime, s.st_size]
+            if manifest.get(name) != current[name]:
+                changed.append(name)
+        
+        # packed issues are stamped with the pack they are in
+        packed = []
+        for name, pack in self.packs.entries():
+            if name in current:
+                continue
+            current[name] = [os.path.basename(pack.filename)]
+            if manifest.get(name) != current[name]:
+                packed.append((name, pack))
+        
+        # rows created since the last rebuild aren't in the manifest
+        for name in (set(manifest) | set(self.issues_data)) - set(current):
+            self._drop_row(name)
+            self.search_index.remove(name)
+        
+        args = [ ('{0}/{1}'.format(self.obj_dir, x), self.directory, self.settings['_fields'],
+                  self.settings['_required'], self.settings['_index'], self.serializer.default) for x in changed ]
+        
+        if jobs > 1 and len(args) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs)
+            try:
+                rows = pool.imap_unordered(read_row, args, chunksize=64)
+                self._apply_rows(rows)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            self._apply_rows(read_row(x) for x in args)
+        
+        self._apply_rows(parse_row(pack.get(x), self.directory, self.settings['_fields'], self.settings['_required'],
+                                   self.settings['_index'], self.serializer.default) for x, pack in packed)
+        
+        self._manifest = current
+        # the rows now come from the object files, so don't merge with
+        # whatever is on disk
+        self._rebuilt = True
+        self.dirty = True
+        return len(changed) + len(packed)
+    
+    def _apply_rows(self, rows):
+        for uuid, status, row, text in rows:
+            if instrument.enabled:
+                instrument.count('objects parsed')
+            if status == 'archived':
+                self._drop_row(uuid)
+                self.search_index.remove(uuid)
+            else:
+                self._put_row(uuid, row)
+                self.search_index.add(uuid, text)
         
 class Issue(object):
+    '''
+    A single issue.
+    
+    Instances are of a subclass generated from the fields schema with a
+    slot per field, see records.issue_class.
+    '''
+    __slots__ = ('_data_dir', '_blobs', '__dict__')
+    
+    _field_names = ()
+    
+    def __new__(cls, directory, fields, required, **kwargs):
+        if not cls._field_names:
+            cls = records.issue_class(cls, fields)
+        return object.__new__(cls)
     
     def __init__(self, directory, fields, required, **kwargs):
         
@@ -152,19 +1206,26 @@ class Issue(object):
             if not f in kwargs:
                 raise PyIssuesException("Missing required field: {0}.".format(f))        
         
-        data = dict(fields)
-        data.update(kwargs)
+        for key, default in fields:
+            if key in kwargs:
+                setattr(self, key, kwargs[key])
+            else:
+                # copy list defaults so issues don't share comments/attachments
+                setattr(self, key, list(default) if isinstance(default, list) else default)
         
-        for key in data:
-            setattr(self, key, data[key])
+        for key in kwargs:
+            if not key in self._field_names:
+                setattr(self, key, kwargs[key])
             
         if self.uuid is None:
+            import uuid
             self.uuid = str(uuid.uuid4())
             
         if self.created is None:
             self.created = timestamp()
             
         self._data_dir = "{0}/files/{1}".format(directory, self.uuid)
+        self._blobs = BlobStore("{0}/files/blobs".format(directory))
     
     def index(self, fields):
         return [ getattr(self, x) for x in fields ] + [len(self.comments), len(self.attachments)]
@@ -175,6 +1236,12 @@ class Issue(object):
         d['uuid'] = uuid
         return d
     
+    def text(self):
+        '''
+        Searchable text - description, body and comments.
+        '''
+        return u'\n'.join([ self.description or u'', self.body or u'' ] + [ x[0] for x in self.comments ])
+    
     def add_comment(self, comment, user):
         '''
         Add a comment.
@@ -192,38 +1259,43 @@ class Issue(object):
         '''
         Attach a file to the issue.
         
+        The content is stored once in the shared blob store, keyed by its
+        SHA-256, and the issue just keeps a reference to it.
+        
         Returns (original_name, stored_name, user, timestamp) as stored
         '''
-        import shutil
-        
         if not os.path.exists(filename):
             raise Exception("No such file: {0}".format(filename))
         
-        if not os.path.exists(self._data_dir):
-            os.makedirs(self._data_dir)
-        
         f = os.path.basename(filename)
         
-        i=0
-        while os.path.exists("{0}/{1}_{2}".format(self._data_dir, f, i)):
-            i += 1
-        
-        target = "{0}/{1}_{2}".format(self._data_dir, f, i)
+        digest = self._blobs.put(filename)
+        logger.debug("Stored {0} as {1}".format(f, digest))
         
-        logger.debug("Storing {0} at {1}".format(f, target))
-        shutil.copy(filename, target)
-        
-        data = (f, os.path.basename(target), user, timestamp())
+        data = (f, blobs.PREFIX + digest, user, timestamp())
         self.attachments.append(data)
         return data
     
     def remove_file(self, index):
         '''
         Remove an attached file (zero based index)
+        Shared stored files are left for PyIssues.prune_files.
         '''
-        _, f = self.get_file(index)
-        os.unlink(f)
+        self._release(self.attachments[index])
         del(self.attachments[index])
+    
+    def release_files(self):
+        '''
+        Drop the references to all attached files, e.g. when the issue is deleted.
+        '''
+        for attachment in self.attachments:
+            self._release(attachment)
+    
+    def _release(self, attachment):
+        if not attachment[1].startswith(blobs.PREFIX):
+            path = "{0}/{1}".format(self._data_dir, attachment[1])
+            if os.path.exists(path):
+                os.unlink(path)
       
     def get_file(self, index):
         '''
@@ -232,16 +1304,38 @@ class Issue(object):
         returns (original, path)
         '''
         attachment = self.attachments[index]
+        if attachment[1].startswith(blobs.PREFIX):
+            return (attachment[0], os.path.realpath(self._blobs.path(attachment[1][len(blobs.PREFIX):])))
         return (attachment[0], "{0}/{1}".format(os.path.realpath(self._data_dir), attachment[1]))
     
     def write(self, stream):
         stream.write(str(self))
     
+    def as_dict(self):
+        data = dict((x, getattr(self, x)) for x in self._field_names)
+        data.update((x, self.__dict__[x]) for x in self.__dict__ if not x[0] == '_')
+        return data
+    
     def __str__(self):
-        return json.dumps({ x: self.__dict__[x] for x in self.__dict__ if not x[0] == '_' }, self.__dict__, indent=2)
+        return json.dumps(self.as_dict(), indent=2)
                 
     def __repr__(self):
         return "<Issue #{0}>".format(self.uuid[:8])
     
+class Descending(object):
+    '''
+    Wraps a sort key to reverse its ordering.
+    '''
+    __slots__ = ('value', )
+    
+    def __init__(self, value):
+        self.value = value
+    
+    def __lt__(self, other):
+        return other.value < self.value
+    
+    def __eq__(self, other):
+        return self.value == other.value
+    
 class PyIssuesException(Exception):
     pass
\ No newline at end of file
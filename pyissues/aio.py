@@ -0,0 +1,83 @@
+'''
+Concurrent access to a tracker for services handling many requests.
+
+    issues = AsyncPyIssues(PyIssues('issues'), workers=8)
+
+    pending = issues.get_many(uuids)
+    ...
+    for issue in pending.get():
+        ...
+
+Every call returns immediately with a multiprocessing AsyncResult (use
+get(), wait() or pass a callback).  Object files are read and written on
+a bounded pool of threads so disk I/O overlaps, while index and database
+changes are made one at a time under a lock, so the on disk format and
+the behaviour of transactions are exactly as for PyIssues.  Updates to
+the same issue are also kept in order, so its object file always ends up
+matching its index row.
+'''
+import threading, zlib
+from multiprocessing.pool import ThreadPool
+
+from locking import STRIPES
+
+class AsyncPyIssues(object):
+
+    def __init__(self, issues, workers=8):
+        self.issues = issues
+        self.lock = threading.RLock()
+        self.pool = ThreadPool(workers)
+        # held from staging an update until its object file is written,
+        # picked by a hash of the uuid as for the object locks
+        self._writes = [ threading.Lock() for i in range(STRIPES) ]
+
+    def _get(self, uuid):
+        with self.lock:
+            path = self.issues.match(uuid)
+        return self.issues._load(path)
+
+    def _update(self, issue, touch):
+        with self._writes[(zlib.crc32(issue.uuid) & 0xffffffff) % STRIPES]:
+            with self.lock:
+                write = self.issues._stage(issue, touch)
+            if write:
+                self.issues._write_object(issue)
+        return issue
+
+    def _locked(self, func, *args, **kwargs):
+        with self.lock:
+            return func(*args, **kwargs)
+
+    def get(self, uuid, callback=None):
+        return self.pool.apply_async(self._get, (uuid, ), callback=callback)
+
+    def get_many(self, uuids, callback=None):
+        '''
+        Load several issues at once, results are in the order given.
+        '''
+        return self.pool.map_async(self._get, uuids, callback=callback)
+
+    def update_many(self, issues, touch=True, callback=None):
+        '''
+        Save several issues at once, see PyIssues.update.
+        '''
+        return self.pool.map_async(lambda x: self._update(x, touch), issues, callback=callback)
+
+    def filter(self, filters=None, sort=None, limit=None, offset=0, callback=None):
+        '''
+        PyIssues.filter, always giving a list.
+        '''
+        return self.pool.apply_async(self._locked, (self.issues.filter, filters, sort, limit, offset),
+                                     callback=callback)
+
+    def flush(self, callback=None):
+        return self.pool.apply_async(self._locked, (self.issues.flush, ), callback=callback)
+
+    def close(self):
+        '''
+        Wait for outstanding work then close the tracker.
+        '''
+        self.pool.close()
+        self.pool.join()
+        with self.lock:
+            self.issues.close()
@@ -0,0 +1,91 @@
+'''
+Content addressed attachment storage.
+
+Files are stored once under their SHA-256 digest, fanned out by the
+first two hex digits, and shared by every issue that attaches them.
+
+The store is committed along with the object files, so it doesn't keep
+counts of its own that clones would each change and then have to merge.
+Blobs that no issue points at any more are only removed by prune, which
+is given the digests still in use from the attachment lists.
+'''
+import os
+
+CHUNK_SIZE = 64 * 1024
+PREFIX = 'sha256:'
+
+class BlobStore(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, filename):
+        '''
+        Copy a file into the store, hashing it as it is copied.
+        Returns the digest.  A blob that is already stored has its mtime
+        bumped so a prune that is running can tell it is in use.
+        '''
+        import hashlib, shutil
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        temp = os.path.join(self.directory, '.incoming.{0}'.format(os.getpid()))
+        h = hashlib.sha256()
+        try:
+            with open(filename, 'rb') as src:
+                with open(temp, 'wb') as dst:
+                    for chunk in iter(lambda: src.read(CHUNK_SIZE), ''):
+                        h.update(chunk)
+                        dst.write(chunk)
+            shutil.copymode(filename, temp)
+
+            digest = h.hexdigest()
+            target = self.path(digest)
+            if os.path.exists(target):
+                os.unlink(temp)
+                os.utime(target, None)
+            else:
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                os.rename(temp, target)
+        except:
+            if os.path.exists(temp):
+                os.unlink(temp)
+            raise
+        return digest
+
+    def digests(self):
+        '''
+        Yields the digest of every stored blob.
+        '''
+        if not os.path.isdir(self.directory):
+            return
+        for prefix in os.listdir(self.directory):
+            if len(prefix) == 2 and os.path.isdir(os.path.join(self.directory, prefix)):
+                for name in os.listdir(os.path.join(self.directory, prefix)):
+                    if name.startswith(prefix) and not name.startswith('.'):
+                        yield name
+
+    def prune(self, live, started):
+        '''
+        Remove the blobs whose digests aren't in live, the set in use when
+        the scan for them began at started.  Blobs written or stored again
+        since may belong to issues the scan missed so are kept.
+        Returns the digests removed.
+        '''
+        removed = []
+        for digest in self.digests():
+            if digest in live:
+                continue
+            path = self.path(digest)
+            try:
+                if os.stat(path).st_mtime >= started:
+                    continue
+                os.unlink(path)
+            except OSError:
+                continue
+            removed.append(digest)
+        return removed
@@ -0,0 +1,288 @@
+'''
+Compact columnar storage for issues.db.
+
+The file is a fixed header, one block per column and a column directory:
+
+    header    : magic, version, row count, column count, directory offset
+    columns   : uuid first (sorted), then the index fields and counts
+    directory : (name, kind, offset, length) for each column
+
+Column kinds:
+
+    F - fixed width utf-8 strings, null padded (uuid, created)
+    D - dictionary encoded, JSON values with 16 or 32 bit codes (status, owner...)
+    S - variable width utf-8 strings with an offset table (description)
+    I - unsigned 32 bit integers (comment and attachment counts)
+
+Files are read through mmap and cells are decoded on demand, so only
+the columns a query touches are ever read.  Rows are views that decode
+a cell when it is indexed rather than the whole row up front.
+'''
+import json, mmap, struct
+from collections import MutableMapping
+
+from util import atomic_file
+
+MAGIC = 'PYIC'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHIIQ')
+ENTRY = struct.Struct('<cQQ')
+
+def _encode(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+def _encode_column(values):
+    '''
+    Pick an encoding for a column, returns (kind, data).
+    '''
+    n = len(values)
+
+    if all(isinstance(x, (int, long)) and not isinstance(x, bool) and 0 <= x < 2**32 for x in values):
+        return 'I', struct.pack('<{0}I'.format(n), *values)
+
+    strings = all(isinstance(x, basestring) for x in values)
+    if strings:
+        encoded = [ _encode(x) for x in values ]
+        widths = set(len(x) for x in encoded)
+        if len(widths) == 1 and not any(x.endswith('\0') for x in encoded):
+            width = widths.pop()
+            return 'F', struct.pack('<H', width) + ''.join(encoded)
+
+    distinct = sorted(set(json.dumps(x) for x in values))
+    if not strings or len(distinct) * 2 <= n:
+        codes = dict((x, i) for i, x in enumerate(distinct))
+        code = 'H' if len(distinct) < 2**16 else 'I'
+        parts = [ struct.pack('<cI', code, len(distinct)) ]
+        for x in distinct:
+            parts.append(struct.pack('<I', len(x)) + x)
+        parts.append(struct.pack('<{0}{1}'.format(n, code), *[ codes[json.dumps(x)] for x in values ]))
+        return 'D', ''.join(parts)
+
+    offsets = [0]
+    for x in encoded:
+        offsets.append(offsets[-1] + len(x))
+    return 'S', struct.pack('<{0}I'.format(n + 1), *offsets) + ''.join(encoded)
+
+def save(filename, data, fields):
+    '''
+    Write a dict of uuid -> row in columnar format.
+    fields names the row columns.
+
+    Written to a temporary file and renamed into place so readers
+    with the old file mapped are unaffected.
+    '''
+    uuids = sorted(data)
+    columns = [ ('uuid', uuids) ] + [ (f, [ data[u][i] for u in uuids ]) for i, f in enumerate(fields) ]
+
+    with atomic_file(filename, 'wb') as f:
+        f.write('\0' * HEADER.size)
+        directory = []
+        for name, values in columns:
+            kind, blob = _encode_column(values)
+            directory.append((name, kind, f.tell(), len(blob)))
+            f.write(blob)
+
+        offset = f.tell()
+        for name, kind, start, length in directory:
+            f.write(struct.pack('<H', len(name)) + name + ENTRY.pack(kind, start, length))
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(uuids), len(columns), offset))
+
+class Column(object):
+    '''
+    Read only view of a single column in a mapped file.
+    '''
+    def __init__(self, buf, kind, offset, length, rows):
+        self.buf = buf
+        self.kind = kind
+        self.rows = rows
+
+        if kind == 'F':
+            self.width = struct.unpack_from('<H', buf, offset)[0]
+            self.start = offset + 2
+        elif kind == 'D':
+            self.code, size = struct.unpack_from('<cI', buf, offset)
+            pos = offset + 5
+            self.values = []
+            for _ in xrange(size):
+                l = struct.unpack_from('<I', buf, pos)[0]
+                self.values.append(json.loads(buf[pos + 4:pos + 4 + l]))
+                pos += 4 + l
+            self.start = pos
+            self.step = struct.calcsize(self.code)
+        elif kind == 'S':
+            self.start = offset + 4 * (rows + 1)
+            self.offsets = offset
+        elif kind == 'I':
+            self.start = offset
+        else:
+            raise ValueError("Unknown column type: {0}".format(kind))
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self.rows:
+            raise IndexError(i)
+
+        if self.kind == 'F':
+            p = self.start + i * self.width
+            return self.buf[p:p + self.width].decode('utf-8')
+        if self.kind == 'D':
+            return self.values[struct.unpack_from('<' + self.code, self.buf, self.start + i * self.step)[0]]
+        if self.kind == 'S':
+            a, b = struct.unpack_from('<2I', self.buf, self.offsets + 4 * i)
+            return self.buf[self.start + a:self.start + b].decode('utf-8')
+        return struct.unpack_from('<I', self.buf, self.start + 4 * i)[0]
+
+    def __iter__(self):
+        n = self.rows
+        if self.kind == 'D':
+            values = self.values
+            for x in struct.unpack_from('<{0}{1}'.format(n, self.code), self.buf, self.start):
+                yield values[x]
+        elif self.kind == 'I':
+            for x in struct.unpack_from('<{0}I'.format(n), self.buf, self.start):
+                yield x
+        else:
+            for i in xrange(n):
+                yield self[i]
+
+class Row(object):
+    '''
+    A row of a columnar file, each cell decoded when it is read.
+    '''
+    __slots__ = ('_columns', '_i')
+
+    def __init__(self, columns, i):
+        self._columns = columns
+        self._i = i
+
+    def __getitem__(self, j):
+        if isinstance(j, slice):
+            return list(self)[j]
+        return self._columns[j][self._i]
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __iter__(self):
+        i = self._i
+        for column in self._columns:
+            yield column[i]
+
+    def __eq__(self, other):
+        return isinstance(other, (list, tuple, Row)) and list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+class ColumnarData(MutableMapping):
+    '''
+    Dict of uuid -> row backed by a columnar file.
+
+    Changes are kept in memory until the data is saved again.
+    '''
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.rows, ncols, offset = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version > VERSION:
+            raise ValueError("Unsupported index format in {0}".format(filename))
+
+        self.names = []
+        self._columns = {}
+        for _ in xrange(ncols):
+            l = struct.unpack_from('<H', self._buf, offset)[0]
+            name = self._buf[offset + 2:offset + 2 + l]
+            kind, start, length = ENTRY.unpack_from(self._buf, offset + 2 + l)
+            offset += 2 + l + ENTRY.size
+            self.names.append(name)
+            self._columns[name] = (kind, start, length)
+
+        self.fields = tuple(self.names[1:])
+        self._cache = {}
+        self._row_columns = None
+        self._positions = None
+        self._changed = {}
+        self._deleted = set()
+
+    def column(self, name):
+        '''
+        Returns a sequence view of a stored column.
+        '''
+        if not name in self._cache:
+            kind, start, length = self._columns[name]
+            self._cache[name] = Column(self._buf, kind, start, length, self.rows)
+        return self._cache[name]
+
+    def _position(self, uuid):
+        if self._positions is None:
+            self._positions = dict((x, i) for i, x in enumerate(self.column('uuid')))
+        return self._positions.get(uuid)
+
+    def row(self, i):
+        if self._row_columns is None:
+            self._row_columns = [ self.column(f) for f in self.fields ]
+        return Row(self._row_columns, i)
+
+    def close(self):
+        '''
+        Unmap the file, rows read from it can't be used after this.
+        '''
+        self._cache = {}
+        self._row_columns = None
+        self._buf.close()
+
+    def __getitem__(self, uuid):
+        if uuid in self._changed:
+            return self._changed[uuid]
+        i = self._position(uuid)
+        if i is None or uuid in self._deleted:
+            raise KeyError(uuid)
+        return self.row(i)
+
+    def __setitem__(self, uuid, row):
+        self._changed[uuid] = row
+        self._deleted.discard(uuid)
+
+    def __delitem__(self, uuid):
+        if uuid in self._changed:
+            del(self._changed[uuid])
+        elif self._position(uuid) is None or uuid in self._deleted:
+            raise KeyError(uuid)
+        self._deleted.add(uuid)
+
+    def __contains__(self, uuid):
+        if uuid in self._changed:
+            return True
+        return not uuid in self._deleted and self._position(uuid) is not None
+
+    def __iter__(self):
+        for uuid in self.column('uuid'):
+            if not uuid in self._changed and not uuid in self._deleted:
+                yield uuid
+        for uuid in self._changed:
+            yield uuid
+
+    def __len__(self):
+        if not self._changed and not self._deleted:
+            return self.rows
+        return sum(1 for _ in self)
+
+    def iteritems(self):
+        columns = [ iter(self.column(f)) for f in self.fields ]
+        for uuid in self.column('uuid'):
+            row = [ next(x) for x in columns ]
+            if not uuid in self._changed and not uuid in self._deleted:
+                yield uuid, row
+        for item in self._changed.iteritems():
+            yield item
@@ -0,0 +1,316 @@
+'''
+Secondary indexes built on top of the issues.db rows.
+'''
+import bisect, json, mmap, os
+
+from util import atomic_file
+
+class FieldIndex(object):
+    '''
+    Inverted index of value -> set of uuids for the enumerable index fields.
+
+    Rows are the positional lists stored in issues.db so we only need
+    to know where each indexed field lives in them.
+    '''
+    def __init__(self, index, fields):
+        self.fields = tuple(fields)
+        self._positions = [ (f, list(index).index(f)) for f in self.fields ]
+        self.postings = dict((f, {}) for f in self.fields)
+
+    @classmethod
+    def build(cls, index, fields, rows):
+        '''
+        Build a new index from a dict of uuid -> row.
+        '''
+        obj = cls(index, fields)
+        for uuid in rows:
+            obj.add(uuid, rows[uuid])
+        return obj
+
+    def add(self, uuid, row):
+        for f, i in self._positions:
+            self.postings[f].setdefault(row[i], set()).add(uuid)
+
+    def remove(self, uuid, row):
+        for f, i in self._positions:
+            values = self.postings[f]
+            uuids = values.get(row[i])
+            if uuids is not None:
+                uuids.discard(uuid)
+                if not uuids:
+                    del(values[row[i]])
+
+    def lookup(self, field, value):
+        return self.postings[field].get(value, set())
+
+    def candidates(self, filters):
+        '''
+        Intersect the postings for any indexed fields in a dict of exact matches.
+
+        Returns (uuids, remaining) where uuids is None if no indexed fields were
+        used and remaining is a dict of filters that still need checking per row.
+        '''
+        remaining = dict(filters)
+        sets = [ self.lookup(f, remaining.pop(f)) for f in self.fields if f in filters ]
+
+        if not sets:
+            return None, remaining
+
+        sets.sort(key=len)
+        result = set(sets[0])
+        for s in sets[1:]:
+            if not result:
+                break
+            result.intersection_update(s)
+        return result, remaining
+
+class UuidIndex(object):
+    '''
+    Sorted list of uuids so stubs can be resolved with a binary search.
+
+    Added uuids are collected and sorted in on the next lookup, so
+    building the index a row at a time doesn't insert into the list for each.
+    '''
+    def __init__(self, uuids=()):
+        self._uuids = sorted(uuids)
+        self._added = set()
+
+    @property
+    def uuids(self):
+        if self._added:
+            self._uuids.extend(x for x in self._added if not self._find(x))
+            self._uuids.sort()
+            self._added = set()
+        return self._uuids
+
+    def _find(self, uuid):
+        i = bisect.bisect_left(self._uuids, uuid)
+        return i < len(self._uuids) and self._uuids[i] == uuid
+
+    def add(self, uuid):
+        self._added.add(uuid)
+
+    def remove(self, uuid):
+        self._added.discard(uuid)
+        i = bisect.bisect_left(self._uuids, uuid)
+        if i < len(self._uuids) and self._uuids[i] == uuid:
+            del(self._uuids[i])
+
+    def matches(self, stub, limit=2):
+        '''
+        Returns up to limit uuids starting with stub.
+        '''
+        uuids = self.uuids
+        result = []
+        i = bisect.bisect_left(uuids, stub)
+        while i < len(uuids) and len(result) < limit and uuids[i].startswith(stub):
+            result.append(uuids[i])
+            i += 1
+        return result
+
+    def __contains__(self, uuid):
+        return self.matches(uuid, 1) == [uuid]
+
+    def __len__(self):
+        return len(self.uuids)
+
+class UuidFile(object):
+    '''
+    Sorted uuids saved as fixed width records so stubs can be resolved with
+    a binary search over the file, without loading the database.
+
+    The first line is a JSON header with the record width and the stamp of
+    the database it was written from.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.header = json.loads(f.readline())
+            self._start = f.tell()
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > self._start else ''
+        self._width = self.header['width'] + 1
+        self.count = (size - self._start) // self._width
+
+    @classmethod
+    def save(cls, filename, uuids, source):
+        uuids = sorted(x.encode('utf-8') for x in uuids)
+        width = max([ len(x) for x in uuids ] or [0])
+        with atomic_file(filename, 'wb') as f:
+            f.write(json.dumps({'width': width, 'source': source}) + '\n')
+            for x in uuids:
+                f.write(x.ljust(width) + '\n')
+
+    def _record(self, i):
+        p = self._start + i * self._width
+        return self._buf[p:p + self._width - 1].rstrip(' ').decode('utf-8')
+
+    def matches(self, stub, limit=2):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid) < stub:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        result = []
+        while lo < self.count and len(result) < limit:
+            uuid = self._record(lo)
+            if not uuid.startswith(stub):
+                break
+            result.append(uuid)
+            lo += 1
+        return result
+
+# sorts after any uuid so (value, _TOP) comes after every entry for value
+_TOP = u'\uffff'
+
+class SortedIndex(object):
+    '''
+    (value, uuid) pairs for one field kept in sorted order, so results
+    ordered by that field can be read off without sorting.
+
+    Like UuidIndex additions are sorted in on the next read, so a rebuild
+    or import sorts once rather than inserting each row.
+    '''
+    def __init__(self, index, field, rows=None):
+        self.field = field
+        self._position = list(index).index(field)
+        self.entries = []
+        self._added = []
+        # a dict of uuid -> row to sort on the first read, which until then
+        # is changed along with the index so changes needn't be tracked
+        self._rows = rows
+
+    @classmethod
+    def build(cls, index, field, rows):
+        '''
+        An index of a dict of uuid -> row, sorted when it is first read.
+        '''
+        return cls(index, field, rows)
+
+    def _sorted(self):
+        if self._rows is not None:
+            self.entries = sorted((self._rows[x][self._position], x) for x in self._rows)
+            self._rows = None
+        if self._added:
+            self.entries.extend(self._added)
+            self.entries.sort()
+            self._added = []
+        return self.entries
+
+    def add(self, uuid, row):
+        if self._rows is None:
+            self._added.append((row[self._position], uuid))
+
+    def remove(self, uuid, row):
+        if self._rows is not None:
+            return
+        entry = (row[self._position], uuid)
+        i = bisect.bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+            del(self.entries[i])
+        elif entry in self._added:
+            self._added.remove(entry)
+
+    def uuids(self, reverse=False):
+        entries = reversed(self._sorted()) if reverse else self._sorted()
+        return ( x[1] for x in entries )
+
+    def range(self, low=None, high=None, include_low=True, include_high=True):
+        '''
+        Uuids with values between low and high in value order, either end
+        open if None.
+        '''
+        entries = self._sorted()
+        start = 0 if low is None else bisect.bisect_left(entries, (low, ) if include_low else (low, _TOP))
+        end = len(entries) if high is None else bisect.bisect_left(entries, (high, _TOP) if include_high else (high, ))
+        return [ x[1] for x in entries[start:end] ]
+
+    def __len__(self):
+        if self._rows is not None:
+            return len(self._rows)
+        return len(self.entries) + len(self._added)
+
+class Aggregates(object):
+    '''
+    Row counts for each combination of values of some groups of fields,
+    kept up to date as rows change so group by queries are O(groups).
+
+    index names the fields of the rows in order, including the comment
+    and attachment counts.
+    '''
+    def __init__(self, index, groups):
+        self.groups = [ tuple(x) for x in groups ]
+        self._positions = [ [ list(index).index(f) for f in g ] for g in self.groups ]
+        self.counts = dict((g, {}) for g in self.groups)
+
+    @classmethod
+    def build(cls, index, groups, rows, field_index=None):
+        '''
+        Count a dict of uuid -> row.  Groups of fields that are all in
+        field_index are counted from its postings instead, so rows are
+        only read for the others.
+        '''
+        obj = cls(index, groups)
+        scan = []
+        for group, positions in zip(obj.groups, obj._positions):
+            if field_index is not None and all(f in field_index.fields for f in group):
+                obj.counts[group] = cross_counts(field_index, group)
+            else:
+                scan.append((obj.counts[group], positions))
+        if scan:
+            for row in rows.itervalues():
+                for counts, positions in scan:
+                    key = tuple(row[i] for i in positions)
+                    counts[key] = counts.get(key, 0) + 1
+        return obj
+
+    def add(self, uuid, row, n=1):
+        for group, positions in zip(self.groups, self._positions):
+            counts = self.counts[group]
+            key = tuple(row[i] for i in positions)
+            c = counts.get(key, 0) + n
+            if c:
+                counts[key] = c
+            else:
+                del(counts[key])
+
+    def remove(self, uuid, row):
+        self.add(uuid, row, -1)
+
+    def dump(self):
+        return [ [list(g), [ list(k) + [v] for k, v in self.counts[g].items() ]] for g in self.groups ]
+
+    def load(self, data):
+        for g, counts in data:
+            self.counts[tuple(g)] = dict((tuple(x[:-1]), x[-1]) for x in counts)
+
+    def lookup(self, fields):
+        '''
+        Returns {values: count} for a group of fields in either order,
+        or {value: count} for a single field, or None if they aren't
+        aggregated.
+        '''
+        fields = tuple(fields)
+        if len(fields) == 1 and fields in self.counts:
+            return dict((k[0], v) for k, v in self.counts[fields].items())
+        if fields in self.counts:
+            return dict(self.counts[fields])
+        if fields[::-1] in self.counts:
+            return dict((k[::-1], v) for k, v in self.counts[fields[::-1]].items())
+        return None
+
+def cross_counts(field_index, fields):
+    '''
+    Returns {(value, ...): count} for several indexed fields by intersecting
+    their postings, which only touches the uuids of each combination.
+    '''
+    groups = [ ((), None) ]
+    for f in fields:
+        groups = [ (key + (value, ), uuids if found is None else found & uuids)
+                   for key, found in groups for value, uuids in field_index.postings[f].items() ]
+        groups = [ x for x in groups if x[1] ]
+    return dict((key, len(uuids)) for key, uuids in groups)
@@ -0,0 +1,139 @@
+'''
+Timers and counters for finding out where the time goes.
+
+Everything is off by default, when the only cost is checking the
+enabled flag.  Turn it on with enable() and print a breakdown with
+report():
+
+    from pyissues import instrument
+
+    instrument.enable()
+    issues.filter(...)
+    instrument.report()
+
+Timers are inclusive, so nested phases are also counted in their parents.
+'''
+import functools, sys, time
+
+enabled = False
+
+# name -> [calls, seconds]
+timers = {}
+
+# name -> total
+counters = {}
+
+def enable(dirshelf=True):
+    '''
+    Start collecting, clearing anything collected so far.
+    With dirshelf set DirShelf I/O is timed too.
+    '''
+    global enabled
+    enabled = True
+    reset()
+    if dirshelf:
+        _wrap_dirshelf()
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    timers.clear()
+    counters.clear()
+
+def count(name, n=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+class _Timer(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        t = timers.get(self.name)
+        if t is None:
+            t = timers[self.name] = [0, 0.0]
+        t[0] += 1
+        t[1] += time.time() - self.start
+
+class _Null(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL = _Null()
+
+def timer(name):
+    '''
+    Context manager timing a block.
+    '''
+    return _Timer(name) if enabled else _NULL
+
+def timed(name):
+    '''
+    Decorator timing every call of a function.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _wrap_dirshelf():
+    '''
+    dirshelve doesn't know about us so wrap its I/O methods, once.
+    '''
+    try:
+        import dirshelve
+    except ImportError:
+        return
+
+    cls = dirshelve.DirShelf
+    if getattr(cls, '_instrumented', False):
+        return
+
+    def wrap(method, name):
+        func = getattr(cls, method)
+        setattr(cls, method, timed(name)(func))
+
+    wrap('_load_item', 'dirshelf read')
+    wrap('_write', 'dirshelf write')
+    wrap('sync', 'dirshelf sync')
+    wrap('_walk', 'dirshelf walk')
+
+    write = cls._write
+    def _write(self, items):
+        if enabled:
+            count('dirshelf files written', len(items))
+            count('dirshelf bytes written', sum(len(x[1]) for x in items))
+        return write(self, items)
+    cls._write = _write
+    cls._instrumented = True
+
+def report(stream=sys.stderr):
+    '''
+    Print the timers slowest first, then the counters.
+    '''
+    if timers:
+        stream.write("{0:30s} {1:>8s} {2:>10s} {3:>10s}\n".format('phase', 'calls', 'total ms', 'each ms'))
+        stream.write('-' * 61 + '\n')
+        for name, (calls, seconds) in sorted(timers.items(), key=lambda x: -x[1][1]):
+            stream.write("{0:30s} {1:8d} {2:10.2f} {3:10.3f}\n".format(name, calls, seconds * 1000, seconds * 1000 / calls))
+    if counters:
+        stream.write('\n')
+        for name, value in sorted(counters.items()):
+            stream.write("{0:30s} {1:>10}\n".format(name, value))
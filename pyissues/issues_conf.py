@@ -5,11 +5,21 @@ milestone = ('0.1', '0.2', '0.3')
 version = ('0.1', '0.2', '0.3')
 
 # Be careful editing anything beyond this point!
-import getpass
+import os
+
+def _user():
+    '''
+    Same as getpass.getuser() but only imports it if the environment doesn't say.
+    '''
+    for name in ('LOGNAME', 'USER', 'LNAME', 'USERNAME'):
+        if os.environ.get(name):
+            return os.environ[name]
+    import getpass
+    return getpass.getuser()
 
 _fields = (('description',  ''),
            ('status',       'open'),
-           ('owner',        getpass.getuser()),
+           ('owner',        _user()),
            ('assigned',     'no-one'),
            ('priority',     'medium'),
            ('version',      version[0]),
@@ -25,8 +35,36 @@ _required = ('description', )
 
 _index = ('description', 'status', 'owner', 'assigned', 'priority', 'version', 'milestone', 'created')
 
+# index fields with a small set of values - these get value -> uuids lookups
+_indexed = ('status', 'owner', 'assigned', 'priority', 'version', 'milestone')
+
+# index fields kept presorted for paged listings
+_sorted = ('created', )
+
+# fields with options that sort and compare in the order they are declared
+# rather than alphabetically, e.g. ('priority', ) lists blockers first with
+# -priority and makes priority >= high include them
+_ranked = ()
+
+# pick up object files changed by git pulls/checkouts when opening the tracker
+_git_refresh = True
+
+# closed issues not updated for this many days get packed
+_pack_days = 90
+
+# pairs of index fields with counts kept up to date for stats
+_aggregates = (('status', 'assigned'), ('status', 'owner'), ('status', 'priority'),
+               ('status', 'milestone'), ('status', 'version'), ('milestone', 'assigned'))
+
 _default_filters = {'status': 'open'}
 
+# format for new databases - 'json' is diff friendly, 'columnar' is compact and fast to open
+_storage = 'json'
+
+# format for object files - 'json' is diff friendly, 'marshal' is faster but
+# isn't safe to read from others so every clone of the tracker must choose it
+_serializer = 'json'
+
 _template = '''
 UUID           : {uuid}
 description    : {description}
@@ -0,0 +1,74 @@
+'''
+Advisory locks shared by every process using a tracker.
+
+Byte 0 of the lock file guards the database and its side files.  Object
+files are guarded by one of STRIPES further bytes picked by a hash of the
+uuid, so writers of different issues rarely wait for each other.
+
+Locks are reentrant and also keep out other threads of the same process.
+Where fcntl isn't available they do nothing.
+'''
+import contextlib, os, thread, zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+STRIPES = 64
+
+class LockFile(object):
+
+    def __init__(self, filename, stripes=STRIPES):
+        self.filename = filename
+        self.stripes = stripes
+        self._fd = None
+        # offset -> RLock so threads of this process queue up too
+        self._locks = {}
+        self._held = {}
+        self._guard = thread.allocate_lock()
+
+    def _acquire(self, offset):
+        import threading
+        with self._guard:
+            lock = self._locks.setdefault(offset, threading.RLock())
+            if self._fd is None:
+                self._fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+        lock.acquire()
+        try:
+            if not self._held.get(offset):
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, offset)
+        except:
+            lock.release()
+            raise
+        self._held[offset] = self._held.get(offset, 0) + 1
+
+    def _release(self, offset):
+        self._held[offset] -= 1
+        if not self._held[offset]:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+        self._locks[offset].release()
+
+    @contextlib.contextmanager
+    def _range(self, offset):
+        if fcntl is None:
+            yield
+            return
+
+        self._acquire(offset)
+        try:
+            yield
+        finally:
+            self._release(offset)
+
+    def database(self):
+        return self._range(0)
+
+    def object(self, uuid):
+        return self._range(1 + (zlib.crc32(uuid) & 0xffffffff) % self.stripes)
+
+    def close(self):
+        with self._guard:
+            if self._fd is not None and not any(self._held.values()):
+                os.close(self._fd)
+                self._fd = None
@@ -0,0 +1,193 @@
+'''
+Cold storage for issues that are no longer worked on.
+
+A pack holds many object files, each compressed with zlib, followed by
+a table of (uuid, offset, length) entries sorted by uuid so a single
+issue can be found with a binary search and read without touching the
+rest of the file.
+
+    header  'PYIP', version
+    records zlib(object file data) ...
+    table   uuid padded to width, offset, length ...
+    footer  count, width, table offset
+'''
+import mmap, os, struct, zlib
+
+from util import atomic_file
+
+MAGIC = 'PYIP'
+VERSION = 1
+
+HEADER = struct.Struct('<4sH')
+ENTRY = struct.Struct('<QI')
+FOOTER = struct.Struct('<IHQ')
+
+class Pack(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a pack file: {0}".format(filename))
+
+        self.count, self._width, self._table = FOOTER.unpack_from(self._buf, len(self._buf) - FOOTER.size)
+        self._size = self._width + ENTRY.size
+
+    @classmethod
+    def write(cls, filename, items):
+        '''
+        Write (uuid, data) pairs to a new pack.
+        '''
+        entries = []
+        with atomic_file(filename, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION))
+            for uuid, data in items:
+                data = zlib.compress(data)
+                entries.append((uuid.encode('utf-8'), f.tell(), len(data)))
+                f.write(data)
+
+            table = f.tell()
+            width = max([ len(x[0]) for x in entries ] or [0])
+            for uuid, offset, length in sorted(entries):
+                f.write(uuid.ljust(width) + ENTRY.pack(offset, length))
+            f.write(FOOTER.pack(len(entries), width, table))
+        return len(entries)
+
+    def _uuid(self, i):
+        p = self._table + i * self._size
+        return self._buf[p:p + self._width].rstrip(' ').decode('utf-8')
+
+    def _find(self, stub):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._uuid(mid) < stub:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def uuids(self):
+        return ( self._uuid(i) for i in range(self.count) )
+
+    def matches(self, stub, limit=2):
+        result = []
+        i = self._find(stub)
+        while i < self.count and len(result) < limit:
+            uuid = self._uuid(i)
+            if not uuid.startswith(stub):
+                break
+            result.append(uuid)
+            i += 1
+        return result
+
+    def get(self, uuid):
+        '''
+        Returns the object data for uuid or None.
+        '''
+        i = self._find(uuid)
+        if i == self.count or self._uuid(i) != uuid:
+            return None
+        offset, length = ENTRY.unpack_from(self._buf, self._table + i * self._size + self._width)
+        return zlib.decompress(self._buf[offset:offset + length])
+
+    def __contains__(self, uuid):
+        return self.matches(uuid, 1) == [uuid]
+
+    def close(self):
+        self._buf.close()
+
+class PackStore(object):
+    '''
+    The packs in a directory, newest first so later copies win.
+    The directory is listed again whenever its mtime changes.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self._packs = None
+        self._stamp = None
+
+    @property
+    def packs(self):
+        try:
+            stamp = os.stat(self.directory).st_mtime
+        except OSError:
+            stamp = None
+        if self._packs is None or stamp != self._stamp:
+            self._stamp = stamp
+            try:
+                names = [ x for x in os.listdir(self.directory) if x.startswith('pack-') and x.endswith('.pack') ]
+            except OSError:
+                names = []
+            names.sort(key=lambda x: int(x[5:-5]), reverse=True)
+            self._packs = [ Pack(os.path.join(self.directory, x)) for x in names ]
+        return self._packs
+
+    def _next_name(self):
+        numbers = [ int(os.path.basename(x.filename)[5:-5]) for x in self.packs ]
+        return os.path.join(self.directory, 'pack-{0}.pack'.format(max(numbers or [0]) + 1))
+
+    def add(self, items):
+        '''
+        Write (uuid, data) pairs to a new pack.
+        '''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        c = Pack.write(self._next_name(), items)
+        self._packs = None
+        return c
+
+    def find(self, uuid):
+        '''
+        Returns the pack holding the current copy of uuid or None.
+        '''
+        for pack in self.packs:
+            if uuid in pack:
+                return pack
+        return None
+
+    def get(self, uuid):
+        pack = self.find(uuid)
+        return None if pack is None else pack.get(uuid)
+
+    def matches(self, stub, limit=2):
+        result = set()
+        for pack in self.packs:
+            result.update(pack.matches(stub, limit))
+        return sorted(result)[:limit]
+
+    def remove(self, uuid):
+        '''
+        Rewrite any packs holding uuid without it.
+        Returns whether it was found.
+        '''
+        found = False
+        for pack in self.packs:
+            if not uuid in pack:
+                continue
+            items = [ (x, pack.get(x)) for x in pack.uuids() if x != uuid ]
+            pack.close()
+            if items:
+                Pack.write(pack.filename, items)
+            else:
+                os.unlink(pack.filename)
+            found = True
+        self._packs = None
+        return found
+
+    def entries(self):
+        '''
+        Yields (uuid, pack) for the current copy of every packed issue.
+        '''
+        seen = set()
+        for pack in self.packs:
+            for uuid in pack.uuids():
+                if not uuid in seen:
+                    seen.add(uuid)
+                    yield uuid, pack
+
+    def __contains__(self, uuid):
+        return self.find(uuid) is not None
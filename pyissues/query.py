@@ -0,0 +1,323 @@
+'''
+A small query language for filtering index rows.
+
+    priority in (high, blocker) and created >= 2026-01-01 and assigned != no-one
+
+Comparisons are =, !=, <, <=, >, >=, ~ (case insensitive substring) and
+in (...), combined with and, or, not and brackets.  Values can be bare
+words or "quoted".  Fields in _ranked compare in the declared order of
+their options, as they sort, so priority >= high includes blocker.
+Anything else, dates included, compares as text, so created < 2026-01-02
+includes all of the 1st.
+
+A query is parsed once and compiled into a single predicate over the raw
+rows.  Where it can, the tracker also narrows the rows to check with the
+field index and the sorted indexes before running it.
+'''
+import re
+
+COUNTS = ('comments', 'attachments')
+
+TOKEN = re.compile(r'''\s*(?:(<=|>=|!=|==|=|<|>|~)|([(),])|"([^"]*)"|'([^']*)'|([^\s()<>=!~,"']+))''', re.UNICODE)
+
+OPERATORS = {'=': '==', '==': '==', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+
+class QueryError(ValueError):
+    pass
+
+def tokenize(text):
+    '''
+    Split a query into (kind, text) with kind one of op, punct, string or word.
+    '''
+    tokens = []
+    pos, end = 0, len(text.rstrip())
+    while pos < end:
+        m = TOKEN.match(text, pos)
+        if m is None or m.end() == pos:
+            raise QueryError("Unexpected {0!r} at {1}".format(text[pos:].strip()[:10], pos))
+        op, punct, double, single, word = m.groups()
+        if op:
+            tokens.append(('op', op))
+        elif punct:
+            tokens.append(('punct', punct))
+        elif word is not None:
+            tokens.append(('word', word))
+        else:
+            tokens.append(('string', double if double is not None else single))
+        pos = m.end()
+    return tokens
+
+class _Parser(object):
+    '''
+    Recursive descent over the tokens, giving a tree of
+    ('or', [nodes]), ('and', [nodes]), ('not', node),
+    ('cmp', field, op, value) and ('in', field, values).
+    '''
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def keyword(self, word):
+        kind, text = self.peek()
+        if kind == 'word' and text.lower() == word:
+            self.pos += 1
+            return True
+        return False
+
+    def punct(self, char):
+        if self.peek() == ('punct', char):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, char):
+        if not self.punct(char):
+            raise QueryError("Expected {0!r} but got {1!r}".format(char, self.peek()[1] or 'end of query'))
+
+    def value(self):
+        kind, text = self.peek()
+        if not kind in ('word', 'string'):
+            raise QueryError("Expected a value but got {0!r}".format(text or 'end of query'))
+        self.pos += 1
+        return text
+
+    def parse(self):
+        node = self.parse_or()
+        if self.pos < len(self.tokens):
+            raise QueryError("Unexpected {0!r}".format(self.peek()[1]))
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.keyword('or'):
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.keyword('and'):
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_not(self):
+        if self.keyword('not'):
+            return ('not', self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self):
+        if self.punct('('):
+            node = self.parse_or()
+            self.expect(')')
+            return node
+
+        kind, field = self.peek()
+        if kind != 'word':
+            raise QueryError("Expected a field but got {0!r}".format(field or 'end of query'))
+        self.pos += 1
+
+        negate = self.keyword('not')
+        if self.keyword('in'):
+            self.expect('(')
+            values = [self.value()]
+            while self.punct(','):
+                values.append(self.value())
+            self.expect(')')
+            node = ('in', field, values)
+            return ('not', node) if negate else node
+        if negate:
+            raise QueryError("Expected 'in' after {0} not".format(field))
+
+        kind, op = self.peek()
+        if kind != 'op':
+            raise QueryError("Expected a comparison after {0}".format(field))
+        self.pos += 1
+        return ('cmp', field, op, self.value())
+
+def parse(text, filters=None):
+    '''
+    Parse a query, and with it any dict of exact matches.
+    '''
+    nodes = [ ('cmp', f, '=', v) for f, v in sorted((filters or {}).items()) ]
+    if text and text.strip():
+        nodes.append(_Parser(tokenize(text)).parse())
+    if not nodes:
+        raise QueryError("Empty query")
+    return Query(nodes[0] if len(nodes) == 1 else ('and', nodes))
+
+def _ranked(field, settings):
+    '''
+    Whether field compares in the order of its options rather than as text.
+    '''
+    return field in settings.get('_ranked', ()) and isinstance(settings.get(field), tuple)
+
+class Query(object):
+    '''
+    A parsed query, compiled against a tracker's index layout on first use.
+    '''
+    def __init__(self, tree):
+        self.tree = tree
+        self._compiled = {}
+
+    def _code(self, node, ref, settings, names):
+        '''
+        Python source for a node, with ref(field) giving the expression
+        for a field and constants collected in names.
+        '''
+        def bind(value):
+            name = '_v{0}'.format(len(names))
+            names[name] = value
+            return name
+
+        kind = node[0]
+        if kind in ('and', 'or'):
+            return '(' + ' {0} '.format(kind).join(self._code(x, ref, settings, names) for x in node[1]) + ')'
+        if kind == 'not':
+            return '(not ' + self._code(node[1], ref, settings, names) + ')'
+
+        field = node[1]
+        expr = ref(field)
+        if kind == 'in':
+            return '({0} in {1})'.format(expr, bind(frozenset(self._value(field, x) for x in node[2])))
+
+        op = node[2]
+        if op == '~' and field in COUNTS:
+            raise QueryError("{0} is a number, ~ only matches text".format(field))
+        value = self._value(field, node[3])
+        if op == '~':
+            return '({0} in ({1} or u"").lower())'.format(bind(value.lower()), expr)
+
+        options = settings.get(field)
+        if op in ('<', '<=', '>', '>=') and _ranked(field, settings):
+            if not value in options:
+                raise QueryError("{0} must be one of {1}".format(field, ', '.join(options)))
+            rank = dict((x, n) for n, x in enumerate(options))
+            expr = '{0}.get({1}, {2})'.format(bind(rank), expr, len(rank))
+            value = rank[value]
+        return '({0} {1} {2})'.format(expr, OPERATORS[op], bind(value))
+
+    def _value(self, field, value):
+        if field in COUNTS:
+            try:
+                return int(value)
+            except ValueError:
+                raise QueryError("{0} must be a number".format(field))
+        return value
+
+    def _fields(self, node):
+        if node[0] in ('and', 'or'):
+            return set().union(*[ self._fields(x) for x in node[1] ])
+        if node[0] == 'not':
+            return self._fields(node[1])
+        return set([node[1]])
+
+    def predicate(self, index, settings):
+        '''
+        Returns test(uuid, row) for the raw rows of issues_data, where
+        row holds the index fields followed by the counts.
+        '''
+        fields = self._fields(self.tree)
+        key = (tuple(index), tuple((f, settings.get(f)) for f in sorted(fields) if _ranked(f, settings)))
+        if not key in self._compiled:
+            positions = dict((f, i) for i, f in enumerate(key[0] + COUNTS))
+            for f in fields:
+                if f != 'uuid' and not f in positions:
+                    raise QueryError("Unknown field {0}".format(f))
+
+            names = {}
+            ref = lambda f: 'u' if f == 'uuid' else 'r[{0}]'.format(positions[f])
+            code = self._code(self.tree, ref, settings, names)
+            self._compiled[key] = eval('lambda u, r: ' + code, names)
+        return self._compiled[key]
+
+    def _test(self, node, settings):
+        '''
+        A comparison node as a test of a single value.
+        '''
+        names = {}
+        return eval('lambda v: ' + self._code(node, lambda f: 'v', settings, names), names)
+
+    def candidates(self, field_index, sorted_index, settings, rows):
+        '''
+        Uuids that can match according to the indexes, or None if the
+        query needs a full scan.  Every candidate still needs checking
+        with the predicate.
+        '''
+        return self._plan(self.tree, field_index, sorted_index, settings, rows)
+
+    def _plan(self, node, field_index, sorted_index, settings, rows):
+        kind = node[0]
+        if kind == 'or':
+            result = set()
+            for x in node[1]:
+                uuids = self._plan(x, field_index, sorted_index, settings, rows)
+                if uuids is None:
+                    return None
+                result.update(uuids)
+            return result
+
+        if kind == 'and':
+            # range bounds on the same sorted field make a single scan
+            sets, bounds = [], {}
+            for x in node[1]:
+                if x[0] == 'cmp' and self._ranged(x[1], field_index, sorted_index, settings) and x[2] in ('<', '<=', '>', '>='):
+                    bounds.setdefault(x[1], []).append(x)
+                    continue
+                uuids = self._plan(x, field_index, sorted_index, settings, rows)
+                if uuids is not None:
+                    sets.append(uuids)
+            for field, nodes in bounds.items():
+                sets.append(self._range(sorted_index[field], nodes))
+
+            if not sets:
+                return None
+            sets.sort(key=len)
+            result = set(sets[0])
+            for s in sets[1:]:
+                if not result:
+                    break
+                result.intersection_update(s)
+            return result
+
+        if kind == 'not':
+            return None
+
+        field = node[1]
+        if field == 'uuid' and (kind == 'in' or node[2] == '='):
+            values = node[2] if kind == 'in' else [node[3]]
+            return set(x for x in values if x in rows)
+
+        if field in field_index.fields:
+            # enumerable so test each value rather than each row
+            test = self._test(node, settings)
+            result = set()
+            for value, uuids in field_index.postings[field].items():
+                if test(value):
+                    result.update(uuids)
+            return result
+
+        if kind == 'cmp' and self._ranged(field, field_index, sorted_index, settings) and node[2] in ('=', '<', '<=', '>', '>='):
+            return self._range(sorted_index[field], [node])
+        return None
+
+    def _ranged(self, field, field_index, sorted_index, settings):
+        '''
+        Whether comparisons on field can be a range scan of its sorted index,
+        which is in value order so not for ranked fields.
+        '''
+        return field in sorted_index and not field in field_index.fields and not _ranked(field, settings)
+
+    def _range(self, index, nodes):
+        low = high = None
+        include_low = include_high = True
+        for _, field, op, value in nodes:
+            if op in ('=', '>', '>=') and (low is None or value > low or (value == low and op == '>')):
+                low, include_low = value, op != '>'
+            if op in ('=', '<', '<=') and (high is None or value < high or (value == high and op == '<')):
+                high, include_high = value, op != '<'
+        return set(index.range(low, high, include_low, include_high))
+
+    def __repr__(self):
+        return 'Query({0!r})'.format(self.tree)
@@ -0,0 +1,82 @@
+'''
+Schema driven record types.
+
+Issues and index rows are created in large numbers by list/filter so
+rather than a dict per object they use classes generated from the
+configured fields - __slots__ for issues, tuples for index rows.
+'''
+import collections
+
+_issue_classes = {}
+_row_classes = {}
+
+def issue_class(base, fields):
+    '''
+    Subclass of base with a slot for each of the (name, default) fields.
+    Anything else still ends up in the instance __dict__.
+    '''
+    names = tuple(x[0] for x in fields)
+    key = (base, names)
+    if not key in _issue_classes:
+        slots = tuple(x for x in names if not hasattr(base, x))
+        _issue_classes[key] = type(base.__name__, (base, ), {'__slots__': slots, '_field_names': names})
+    return _issue_classes[key]
+
+class RowMixin(object):
+    '''
+    Dict style access for index rows, so row['status'], row.get('status'),
+    'status' in row, dict(row) and comparing with a dict work as they did
+    when rows were dicts.  Iterating still gives the values as for any
+    tuple, rows can't be changed and json.dumps sees a list, so use
+    as_dict() for a copy to change or serialize.
+    '''
+    __slots__ = ()
+
+    def __contains__(self, key):
+        if isinstance(key, basestring):
+            return key in self._positions
+        return tuple.__contains__(self, key)
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return tuple.__getitem__(self, self._positions[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return zip(self._fields, self)
+
+    def as_dict(self):
+        return dict(zip(self._fields, self))
+
+def row_class(fields):
+    '''
+    Tuple type for an index row: uuid, the index fields then the comment and attachment counts.
+    '''
+    names = ('uuid', ) + tuple(fields) + ('comments', 'attachments')
+    if not names in _row_classes:
+        base = collections.namedtuple('IndexRow', names)
+        _row_classes[names] = type('IndexRow', (RowMixin, base),
+                                   {'__slots__': (), '_positions': dict((x, i) for i, x in enumerate(names))})
+    return _row_classes[names]
@@ -0,0 +1,312 @@
+'''
+Full text search over issue text.
+
+An inverted index of token -> {uuid: [positions]} stored as JSON, with
+BM25 ranking, "quoted phrases" and prefix* queries.
+
+The index is a directory of small shards so an update only rewrites the
+shards it touches and a search only reads the shards for its terms:
+
+    meta    document count and total length
+    t-XX    postings {term: {uuid: [positions]}} for terms starting XX
+    d-XX    {uuid: {term: [positions]}} for uuids starting XX, to find
+            which postings an update changes
+    l-XX    {uuid: length} for uuids starting XX, for scoring
+
+where XX is the first two characters, hex encoded.
+'''
+import json, math, os, re, shutil
+
+from util import atomic_file
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+QUERY = re.compile(r'"([^"]*)"|(\S+)', re.UNICODE)
+
+K1 = 1.2
+B = 0.75
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+def parse_query(query):
+    '''
+    Split a query into clauses of ('term', word), ('prefix', stub) or ('phrase', [words]).
+    '''
+    clauses = []
+    for phrase, word in QUERY.findall(query):
+        if phrase:
+            words = tokenize(phrase)
+            if len(words) > 1:
+                clauses.append(('phrase', words))
+            elif words:
+                clauses.append(('term', words[0]))
+        elif word.endswith('*') and tokenize(word):
+            clauses.append(('prefix', tokenize(word)[0]))
+        else:
+            clauses.extend(('term', x) for x in tokenize(word))
+    return clauses
+
+def forward(text):
+    '''
+    Returns (length, {term: [positions]}) for a document.
+    '''
+    positions = {}
+    tokens = tokenize(text)
+    for i, token in enumerate(tokens):
+        positions.setdefault(token, []).append(i)
+    return len(tokens), positions
+
+def shard(kind, key):
+    return '{0}-{1}'.format(kind, key[:2].encode('utf-8').encode('hex'))
+
+class SearchIndex(object):
+    '''
+    Changes are kept in memory, and seen by searches, until save.  Saving
+    reads the shards the changes touch again and rewrites just those, so
+    changes saved by other processes in the meantime are kept.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.dirty = False
+        # uuid -> (length, {term: [positions]}), or None if removed, since the last save
+        self._changes = {}
+        self._replace = False
+        # shard name -> (stamp, data) read for searches, and those
+        # checked to be current during this search
+        self._cache = {}
+        self._checked = set()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self, name):
+        try:
+            with open(self._path(name)) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+
+    def _read(self, name):
+        '''
+        A shard for searching, cached until the file changes.
+        '''
+        if self._replace:
+            return {}
+        if name in self._checked:
+            return self._cache[name][1]
+        try:
+            s = os.stat(self._path(name))
+            stamp = [s.st_size, s.st_mtime, s.st_ino]
+        except OSError:
+            return {}
+        cached = self._cache.get(name)
+        if cached is None or cached[0] != stamp:
+            cached = self._cache[name] = (stamp, self._load(name))
+        self._checked.add(name)
+        return cached[1]
+
+    def add(self, uuid, text):
+        self._changes[uuid] = None if text is None else forward(text)
+        self.dirty = True
+
+    def remove(self, uuid):
+        self.add(uuid, None)
+
+    def clear(self):
+        self._changes = {}
+        self._replace = True
+        self.dirty = True
+
+    def pending(self):
+        '''
+        The changes not yet saved, to go back to with restore.
+        '''
+        return dict(self._changes), self._replace, self.dirty
+
+    def restore(self, pending):
+        changes, self._replace, self.dirty = pending
+        self._changes = dict(changes)
+
+    def save(self):
+        '''
+        Write the shards touched by changes since the last save.
+        '''
+        if not self.dirty:
+            return
+        if self._replace and os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        shards = {}
+        changed = set()
+        def get(name):
+            if not name in shards:
+                shards[name] = {} if self._replace else self._load(name)
+            return shards[name]
+
+        meta = get('meta')
+        count, total = meta.get('count', 0), meta.get('total', 0)
+
+        for uuid, doc in self._changes.items():
+            docs = get(shard('d', uuid))
+            old = docs.get(uuid)
+            length, new = doc or (None, None)
+            if old == new:
+                continue
+
+            old_terms, new_terms = old or {}, new or {}
+            for term in set(old_terms) | set(new_terms):
+                if old_terms.get(term) == new_terms.get(term):
+                    continue
+                name = shard('t', term)
+                postings = get(name)
+                if term in new_terms:
+                    postings.setdefault(term, {})[uuid] = new_terms[term]
+                elif term in postings:
+                    postings[term].pop(uuid, None)
+                    if not postings[term]:
+                        del(postings[term])
+                changed.add(name)
+
+            lengths = get(shard('l', uuid))
+            if old is not None:
+                count -= 1
+                total -= lengths.pop(uuid, 0)
+                del(docs[uuid])
+            if new is not None:
+                count += 1
+                total += length
+                lengths[uuid] = length
+                docs[uuid] = new
+            changed.update([shard('d', uuid), shard('l', uuid)])
+
+        if changed:
+            shards['meta'] = {'count': count, 'total': total}
+            changed.add('meta')
+
+        for name in changed:
+            if shards[name]:
+                with atomic_file(self._path(name)) as f:
+                    json.dump(shards[name], f)
+            elif os.path.exists(self._path(name)):
+                os.unlink(self._path(name))
+            self._cache.pop(name, None)
+
+        self._changes = {}
+        self._replace = False
+        self.dirty = False
+
+    def _postings(self, term, unsaved):
+        postings = self._read(shard('t', term)).get(term, {})
+        if unsaved:
+            postings = dict((u, p) for u, p in postings.items() if not u in unsaved)
+            for uuid, doc in unsaved.items():
+                if doc is not None and term in doc[1]:
+                    postings[uuid] = doc[1][term]
+        return postings
+
+    def _lengths(self, unsaved):
+        '''
+        Returns a function giving the length of a document, which reads
+        each length shard at most once.
+        '''
+        shards = {}
+        def length(uuid):
+            if uuid in unsaved:
+                return unsaved[uuid][0]
+            lengths = shards.get(uuid[:2])
+            if lengths is None:
+                lengths = shards[uuid[:2]] = self._read(shard('l', uuid))
+            return lengths.get(uuid, 0)
+        return length
+
+    def _totals(self, unsaved):
+        meta = self._read('meta')
+        count, total = meta.get('count', 0), meta.get('total', 0)
+        for uuid, doc in unsaved.items():
+            old = self._read(shard('l', uuid)).get(uuid)
+            if old is not None:
+                count -= 1
+                total -= old
+            if doc is not None:
+                count += 1
+                total += doc[0]
+        return count, total
+
+    def _expand(self, stub, unsaved):
+        '''
+        Terms starting with stub, from the shards that can hold them.
+        '''
+        if len(stub) >= 2:
+            names = [ shard('t', stub) ]
+        else:
+            start = shard('t', stub)
+            try:
+                names = [ x for x in os.listdir(self.directory) if x.startswith(start) ]
+            except OSError:
+                names = []
+
+        terms = set()
+        for name in names:
+            terms.update(x for x in self._read(name) if x.startswith(stub))
+        for doc in unsaved.values():
+            if doc is not None:
+                terms.update(x for x in doc[1] if x.startswith(stub))
+        return sorted(terms)
+
+    def _phrase(self, words, unsaved):
+        '''
+        Returns {uuid: [positions of the first word]} for docs containing the phrase.
+        '''
+        lists = [ self._postings(x, unsaved) for x in words ]
+        result = {}
+        for uuid in set(lists[0]).intersection(*lists[1:]):
+            following = [ set(x[uuid]) for x in lists[1:] ]
+            starts = [ p for p in lists[0][uuid] if all(p + i + 1 in s for i, s in enumerate(following)) ]
+            if starts:
+                result[uuid] = starts
+        return result
+
+    def search(self, query, limit=None):
+        '''
+        Returns [(uuid, score)] for documents matching every clause, best first.
+        '''
+        clauses = parse_query(query)
+        if not clauses:
+            return []
+        self._checked = set()
+
+        unsaved = self._changes
+        n, total = self._totals(unsaved)
+        if not n:
+            return []
+        avg = float(total) / n or 1.0
+        length = self._lengths(unsaved)
+        scores = None
+
+        for kind, value in clauses:
+            if kind == 'term':
+                matches = [ self._postings(value, unsaved) ]
+            elif kind == 'prefix':
+                matches = [ self._postings(x, unsaved) for x in self._expand(value, unsaved) ]
+            else:
+                matches = [ self._phrase(value, unsaved) ]
+
+            clause = {}
+            for postings in matches:
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for uuid, positions in postings.items():
+                    tf = len(positions)
+                    score = idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length(uuid) / avg))
+                    clause[uuid] = clause.get(uuid, 0) + score
+
+            if scores is None:
+                scores = clause
+            else:
+                scores = dict((x, scores[x] + clause[x]) for x in scores if x in clause)
+            if not scores:
+                return []
+
+        result = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+        return result[:limit] if limit else result
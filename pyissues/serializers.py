@@ -0,0 +1,108 @@
+'''
+Formats for issue object files and dirshelve shelves.
+
+Each store has a default format which is written as is, so files written
+by older versions still load: JSON for object files, as it diffs and merges
+nicely, and pickle for shelves.  JSON can also be written after a header
+naming it, so stores of another format can hold it and still load.
+
+Marshal is much quicker to load and store than either, but like pickle
+it isn't safe to decode data from just anyone.  Both are only ever a
+store's default, chosen by whoever owns it, and never read from a header,
+as object files can come from anyone with commit access.
+'''
+import json, marshal
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# followed by the serializer's tag
+HEADER = 'PYIB'
+
+class JSONSerializer(object):
+    name = 'json'
+    tag = '\x03'
+
+    def dumps(self, data):
+        return json.dumps(data, indent=2)
+
+    def loads(self, data):
+        return json.loads(data)
+
+class MarshalSerializer(object):
+    '''
+    Fastest for builtin types, but the format is tied to the Python version.
+    '''
+    name = 'marshal'
+    tag = None
+
+    def dumps(self, data):
+        return marshal.dumps(data)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+class PickleSerializer(object):
+    name = 'pickle'
+    tag = None
+
+    def dumps(self, data):
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+SERIALIZERS = dict((x.name, x) for x in (JSONSerializer(), MarshalSerializer(), PickleSerializer()))
+
+_TAGGED = dict((x.tag, x) for x in SERIALIZERS.values() if x.tag)
+
+def get(name, default='json'):
+    '''
+    A serializer for a store whose default format is default.
+    '''
+    serializer = SERIALIZERS.get(name)
+    if serializer is None or not (serializer.tag or name == default):
+        raise ValueError("Unknown serializer: {0}".format(name))
+    return serializer
+
+def dumps(serializer, data, default='json'):
+    '''
+    Encode data for a store, with a header unless it's in the default format.
+    '''
+    encoded = serializer.dumps(data)
+    if serializer.name == default:
+        return encoded
+    return HEADER + serializer.tag + encoded
+
+def loads(data, default='json'):
+    '''
+    Decode data written in the default format or with a header.  Plain JSON,
+    e.g. object files from before a tracker changed format, is tried if
+    the default can't decode it.
+    '''
+    if data.startswith(HEADER) and data[len(HEADER):len(HEADER) + 1] in _TAGGED:
+        return _TAGGED[data[len(HEADER)]].loads(data[len(HEADER) + 1:])
+    try:
+        return SERIALIZERS[default].loads(data)
+    except ValueError:
+        if default == 'json':
+            raise
+        return json.loads(data)
+
+class Store(object):
+    '''
+    Writes name for a store whose default format is default, or name if
+    not given, and reads anything the store can hold.  Can be given to
+    dirshelve.open as its serializer.
+    '''
+    def __init__(self, name, default=None):
+        self.default = name if default is None else default
+        self.serializer = get(name, self.default)
+
+    def dumps(self, data):
+        return dumps(self.serializer, data, self.default)
+
+    def loads(self, data):
+        return loads(data, self.default)
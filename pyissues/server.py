@@ -0,0 +1,162 @@
+'''
+Keeps a tracker warm in memory and serves CLI actions over a Unix socket.
+
+Each request is a single JSON line {"action": name, "args": [...], "cwd": dir,
+"user": name, "level": n} and gets a single JSON line back {"output": text,
+"log": text, "status": code}, the log holding messages from level up.  Requests
+are handled one at a time so the tracker never sees concurrent changes.
+
+Before each request the objs directory and database are checked, so files
+changed by git pulls or by other processes are picked up.
+'''
+import json, os, sys, errno, logging
+
+logger = logging.getLogger(__name__)
+
+SOCKET = '.server.sock'
+
+def socket_path(directory):
+    return os.path.join(os.path.abspath(directory), SOCKET)
+
+def _mtime(path):
+    try:
+        s = os.stat(path)
+        return (s.st_mtime, s.st_size, s.st_ino)
+    except OSError:
+        return None
+
+def call(directory, action, args, user=None, level=logging.INFO):
+    '''
+    Forward an action to a running server, to run as user with log
+    messages from level up written to stderr here.
+    Returns (output, status) or None if no server is listening.
+    '''
+    # cheap check first as this is on every command's path
+    if not os.path.exists(socket_path(directory)):
+        return None
+    
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path(directory))
+    except socket.error as e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+
+    try:
+        sock.sendall(json.dumps({'action': action, 'args': list(args), 'cwd': os.getcwd(),
+                                 'user': user, 'level': level}) + '\n')
+        response = json.loads(sock.makefile('rb').readline())
+    finally:
+        sock.close()
+    if response.get('log'):
+        sys.stderr.write(response['log'].encode('latin-1'))
+    return response['output'].encode('latin-1'), response['status']
+
+class Server(object):
+    '''
+    dispatch(issues, action, args) runs an action, printing its output,
+    and returns an exit status.
+    '''
+    def __init__(self, issues, dispatch):
+        self.issues = issues
+        self.dispatch = dispatch
+        self.path = socket_path(issues.directory)
+        self._stamps = None
+        self.running = False
+
+    def _current(self):
+        return (_mtime(self.issues.obj_dir), _mtime(self.issues.issues_file))
+
+    def refresh(self):
+        '''
+        Reload if the database was written by someone else and reapply
+        any object files that changed underneath us.
+        '''
+        objs, db = self._current()
+        if self._stamps is not None:
+            if db != self._stamps[1]:
+                logger.debug("Database changed - reloading")
+                self.issues._unload()
+            if objs != self._stamps[0]:
+                logger.debug("Objects changed - refreshing")
+                self.issues.rebuild(incremental=True)
+                self.issues.flush()
+        self._stamps = self._current()
+
+    def handle(self, request):
+        from cStringIO import StringIO
+        cwd, user = os.getcwd(), os.environ.get('LOGNAME')
+        stdout, sys.stdout = sys.stdout, StringIO()
+        
+        # log messages go back to the caller with the output, those the
+        # server's own level lets through at least
+        log = StringIO()
+        handler = logging.StreamHandler(log)
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        handler.setLevel(request.get('level', logging.INFO))
+        logging.getLogger().addHandler(handler)
+        try:
+            os.chdir(request.get('cwd', cwd))
+            # comments and attachments are recorded under the caller's name
+            if request.get('user'):
+                os.environ['LOGNAME'] = request['user']
+            self.refresh()
+            status = self.dispatch(self.issues, request['action'], request.get('args', []))
+            self.issues.flush()
+            self._stamps = self._current()
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            logging.getLogger().removeHandler(handler)
+            if user is None:
+                os.environ.pop('LOGNAME', None)
+            else:
+                os.environ['LOGNAME'] = user
+            os.chdir(cwd)
+        # latin-1 round trips arbitrary bytes e.g. attachments
+        return {'output': output.decode('latin-1'), 'log': log.getvalue().decode('latin-1'), 'status': status or 0}
+
+    def _listen(self):
+        if call(self.issues.directory, None, []) is not None:
+            raise Exception("Server already running on {0}".format(self.path))
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(16)
+        return sock
+
+    def serve(self):
+        sock = self._listen()
+        logger.info("Serving on {0}".format(self.path))
+        self.running = True
+        try:
+            while self.running:
+                conn, _ = sock.accept()
+                try:
+                    request = json.loads(conn.makefile('rb').readline())
+                    if request['action'] is None:
+                        response = {'output': u'', 'status': 0}
+                    elif request['action'] == '_stop':
+                        self.running = False
+                        response = {'output': u'', 'status': 0}
+                    else:
+                        response = self.handle(request)
+                    conn.sendall(json.dumps(response) + '\n')
+                except Exception as e:
+                    logger.exception("Request failed")
+                    try:
+                        conn.sendall(json.dumps({'output': u'Error: {0}\n'.format(e), 'status': 1}) + '\n')
+                    except IOError:
+                        pass
+                finally:
+                    conn.close()
+        finally:
+            sock.close()
+            os.unlink(self.path)
+            self.issues.flush()
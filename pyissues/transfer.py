@@ -0,0 +1,51 @@
+'''
+Streaming readers and writers for bulk import/export.
+
+Everything works on iterables of dicts so large dumps never have to
+be held in memory.
+'''
+import csv, json, itertools
+
+FORMATS = ('jsonl', 'csv')
+
+def read_jsonl(stream):
+    '''
+    Yields a dict per non blank line.
+    '''
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+def write_jsonl(stream, items):
+    c = 0
+    for item in items:
+        stream.write(json.dumps(item) + '\n')
+        c += 1
+    return c
+
+def read_csv(stream):
+    '''
+    Yields a dict per row, keyed by the header line.
+    '''
+    for row in csv.DictReader(stream):
+        yield dict((k.decode('utf-8'), v.decode('utf-8')) for k, v in row.items() if k is not None)
+
+def write_csv(stream, items, fields):
+    writer = csv.writer(stream)
+    writer.writerow(fields)
+    c = 0
+    for item in items:
+        writer.writerow([ u'' if item.get(x) is None else unicode(item[x]).encode('utf-8') for x in fields ])
+        c += 1
+    return c
+
+def batches(items, size):
+    '''
+    Split an iterable into lists of at most size items.
+    '''
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,131 @@
+'''
+Small file helpers shared by the storage modules.
+'''
+import contextlib, os, thread
+
+@contextlib.contextmanager
+def atomic_file(filename, mode='w'):
+    '''
+    Open a temporary file next to filename and rename it into place on
+    success, so readers never see a partially written file.
+
+    The data is synced to disk before the rename and the directory after
+    it, so after a crash or power loss filename holds either the old or
+    the new contents.
+
+    The temporary name starts with a dot so it is skipped by directory scans,
+    and includes the process and thread so concurrent writers don't collide.
+    '''
+    head, tail = os.path.split(filename)
+    path = os.path.join(head, '.{0}.{1}-{2}.tmp'.format(tail, os.getpid(), thread.get_ident()))
+    try:
+        with open(path, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path, filename)
+    except:
+        if os.path.exists(path):
+            os.unlink(path)
+        raise
+    sync_dir(head or '.')
+
+def sync_dir(directory):
+    '''
+    Make renames and new files in directory durable, where the platform allows.
+    '''
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+CHUNK_SIZE = 64 * 1024
+
+def copy_range(src, dst, offset=0, length=None):
+    '''
+    Copy length bytes (or up to the end) starting at offset from one binary
+    file to another without reading it all into memory.
+
+    Uses os.sendfile when it is available and both ends are real files,
+    otherwise streams in chunks.  Returns the number of bytes copied.
+    '''
+    total = 0
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is not None:
+        try:
+            dst.flush()
+            infd, outfd = src.fileno(), dst.fileno()
+            while length is None or total < length:
+                n = sendfile(outfd, infd, offset + total, CHUNK_SIZE if length is None else min(CHUNK_SIZE, length - total))
+                if not n:
+                    break
+                total += n
+            return total
+        except (AttributeError, ValueError, IOError, OSError):
+            if total:
+                raise
+
+    src.seek(offset)
+    while length is None or total < length:
+        chunk = src.read(CHUNK_SIZE if length is None else min(CHUNK_SIZE, length - total))
+        if not chunk:
+            break
+        dst.write(chunk)
+        total += len(chunk)
+    return total
+
+def head_length(f, lines):
+    '''
+    Number of bytes in the first n lines, reading forwards in chunks so a
+    file without newlines isn't read into memory in one go.
+    '''
+    f.seek(0)
+    length = found = 0
+    if lines <= 0:
+        return 0
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return length
+        i = -1
+        while True:
+            i = chunk.find('\n', i + 1)
+            if i < 0:
+                break
+            found += 1
+            if found == lines:
+                return length + i + 1
+        length += len(chunk)
+
+def tail_offset(f, lines):
+    '''
+    Offset of the start of the last n lines, reading backwards from the end.
+    '''
+    f.seek(0, os.SEEK_END)
+    end = pos = f.tell()
+    if lines <= 0:
+        return end
+    found = 0
+    while pos > 0:
+        size = min(CHUNK_SIZE, pos)
+        pos -= size
+        f.seek(pos)
+        chunk = f.read(size)
+        # a trailing newline ends the last line rather than starting a new one
+        if pos + size == end and chunk.endswith('\n'):
+            chunk = chunk[:-1]
+        i = len(chunk)
+        while True:
+            i = chunk.rfind('\n', 0, i)
+            if i < 0:
+                break
+            found += 1
+            if found == lines:
+                return pos + i + 1
+    return 0
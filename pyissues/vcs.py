@@ -0,0 +1,87 @@
+'''
+Just enough git to tell which object files changed between two commits.
+
+HEAD is read straight from the .git directory so checking whether
+anything has changed doesn't need a subprocess.  Only diffing runs git,
+and that is always against the local repository.
+'''
+import os
+
+class GitError(Exception):
+    pass
+
+def find_git_dir(path):
+    '''
+    The .git directory for the repository containing path, or None.
+    '''
+    path = os.path.abspath(path)
+    while True:
+        candidate = os.path.join(path, '.git')
+        if os.path.isdir(candidate):
+            return candidate
+        if os.path.isfile(candidate):
+            # worktrees and submodules have a file pointing at the real directory
+            with open(candidate) as f:
+                line = f.readline().strip()
+            if line.startswith('gitdir:'):
+                return os.path.normpath(os.path.join(path, line[7:].strip()))
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+def resolve(git_dir, ref):
+    '''
+    The commit a ref points at, or None if it doesn't exist yet.
+    '''
+    # worktrees keep shared refs in the common directory
+    common = _read(os.path.join(git_dir, 'commondir'))
+    common = os.path.normpath(os.path.join(git_dir, common)) if common else git_dir
+
+    for d in (git_dir, common):
+        value = _read(os.path.join(d, ref))
+        if value is not None:
+            return value
+
+    packed = _read(os.path.join(common, 'packed-refs'))
+    for line in (packed or '').splitlines():
+        if line.endswith(' ' + ref):
+            return line.split(' ', 1)[0]
+    return None
+
+def head(git_dir):
+    '''
+    The commit HEAD points at, or None if there are no commits.
+    '''
+    value = _read(os.path.join(git_dir, 'HEAD'))
+    if value is None:
+        return None
+    if value.startswith('ref:'):
+        return resolve(git_dir, value[4:].strip())
+    return value
+
+def changed(directory, old, new):
+    '''
+    Files under directory changed between two commits, as a list of
+    (status, name) with status one of A, M or D and names relative to
+    directory.
+    '''
+    import subprocess
+    try:
+        output = subprocess.Popen(['git', 'diff', '--name-status', '--no-renames', '--relative', '-z', old, new, '--', '.'],
+                                  cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = output.communicate()
+    except OSError as e:
+        raise GitError("Unable to run git: {0}".format(e))
+    if output.returncode:
+        raise GitError(err.strip())
+
+    parts = out.split('\0')
+    return [ (parts[i][0], parts[i + 1]) for i in range(0, len(parts) - 1, 2) ]
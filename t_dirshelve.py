@@ -1,10 +1,14 @@
 import unittest
 import dirshelve
+from pyissues import serializers
 
-import os, shutil
+import os, shutil, pickle, marshal
 
 TEST_DIR = 'testing'
 
+def listdir(path):
+    return [ x for x in os.listdir(path) if x != dirshelve.MANIFEST ]
+
 class DirShelveTest(unittest.TestCase):
 
     def setUp(self):
@@ -17,14 +21,14 @@ class DirShelveTest(unittest.TestCase):
         self.shelf['test1'] = 'one'
         
         self.assertEqual(self.shelf._cache['test1'], 'one')
-        self.assertEqual(os.listdir(TEST_DIR), ['test1'])
+        self.assertEqual(listdir(TEST_DIR), ['test1'])
         
         self.assertEqual(self.shelf.sync(), [])
         
         self.shelf['test/test2'] = 'two'
         self.assertEqual(self.shelf._cache['test/test2'], 'two')
-        self.assertEqual(os.listdir(TEST_DIR), ['test1', 'test'])
-        self.assertEqual(os.listdir(TEST_DIR + '/test'), ['test2'])
+        self.assertEqual(listdir(TEST_DIR), ['test1', 'test'])
+        self.assertEqual(listdir(TEST_DIR + '/test'), ['test2'])
     
     def test_get(self):
         self.shelf['test1'] = 'one'
@@ -67,10 +71,10 @@ class DirShelveWritebackTest(DirShelveTest):
         self.shelf['test1'] = 'one'
         
         self.assertEqual(self.shelf._cache['test1'], 'one')
-        self.assertEqual(os.listdir(TEST_DIR), [])
+        self.assertEqual(listdir(TEST_DIR), [])
         
         self.assertEqual(self.shelf.sync(), ['test1'])
-        self.assertEqual(os.listdir(TEST_DIR), ['test1'])
+        self.assertEqual(listdir(TEST_DIR), ['test1'])
     
     def test_delete(self):
         super(DirShelveWritebackTest, self).test_delete()
@@ -96,13 +100,156 @@ class DirShelveWritebackTest(DirShelveTest):
         self.setUp()
         self.assertEqual(self.shelf['test1'], 'one')
         
-        self.assertTrue('test1' in self.shelf._initial)
+        # immutable values can only change by assignment
+        self.assertFalse('test1' in self.shelf._initial)
         self.assertEqual(self.shelf.sync(), [])
         
         self.shelf['test1'] = 1
         self.assertEqual(self.shelf.sync(), ['test1'])
+        self.assertEqual(self.shelf._initial.keys(), [])
+        
+        # mutable values are tracked again when next read
+        self.shelf['test2'] = [1]
+        self.assertEqual(self.shelf.sync(), ['test2'])
+        self.shelf['test2'].append(2)
+        self.assertEqual(self.shelf.sync(), ['test2'])
+        self.assertEqual(self.shelf.sync(), [])
+        self.assertEqual(self.shelf['test2'], [1, 2])
+        self.assertEqual(self.shelf.sync(), [])
+    
+    def test_protocol(self):
+        # data written with another pickle protocol isn't rewritten unchanged
+        with open(os.path.join(TEST_DIR, 'test1'), 'wb') as f:
+            f.write(pickle.dumps({'a': [1]}, 0))
+        self.assertEqual(self.shelf['test1'], {'a': [1]})
+        self.assertEqual(self.shelf.sync(), [])
+        
+        self.shelf['test1']['a'].append(2)
+        self.assertEqual(self.shelf.sync(), ['test1'])
+        
+    def test_lru(self):
+        self.shelf.cache_size = 2
+        
+        self.shelf['test1'] = [1]
+        self.shelf['test2'] = [2]
+        self.assertEqual(listdir(TEST_DIR), [])
+        
+        # least recently used dirty item is written when evicted
+        self.shelf['test3'] = [3]
+        self.assertEqual(self.shelf._cache.keys(), ['test2', 'test3'])
+        self.assertEqual(listdir(TEST_DIR), ['test1'])
+        self.assertFalse('test1' in self.shelf._initial)
+        
+        # reading refreshes an item, in place changes are kept on eviction
+        self.shelf['test1'].append(4)
+        self.shelf['test2']
+        self.assertEqual(self.shelf._cache.keys(), ['test1', 'test2'])
+        self.assertEqual(sorted(listdir(TEST_DIR)), ['test1', 'test2', 'test3'])
+        self.shelf['test4'] = [4]
+        self.assertEqual(self.shelf._cache.keys(), ['test2', 'test4'])
+        self.shelf['test5'] = [5]
+        self.assertEqual(self.shelf['test1'], [1, 4])
+        
+        self.assertEqual(len(self.shelf), 5)
+        self.shelf.close()
+        self.setUp()
+        self.assertEqual([ self.shelf['test{0}'.format(i)] for i in range(1, 6) ], [[1, 4], [2], [3], [4], [5]])
 
         
+class DirShelveMarshalTest(DirShelveTest):
+    
+    def setUp(self):
+        self.shelf = dirshelve.open(TEST_DIR, serializer=serializers.Store('marshal'))
+        
+    def test_mixed(self):
+        self.shelf['test1'] = {'a': [1, 2]}
+        self.assertEqual(open(TEST_DIR + '/test1', 'rb').read(), marshal.dumps({'a': [1, 2]}))
+        self.shelf.close()
+        
+        # JSON is written with a header so a store of any format can hold it
+        self.shelf = dirshelve.open(TEST_DIR, serializer=serializers.Store('json', 'marshal'))
+        self.assertEqual(self.shelf['test1'], {'a': [1, 2]})
+        self.shelf['test2'] = {'b': [3, 4]}
+        self.assertTrue(open(TEST_DIR + '/test2', 'rb').read().startswith(serializers.HEADER))
+        self.shelf.close()
+        self.setUp()
+        self.assertEqual(self.shelf['test2'], {'b': [3, 4]})
+        self.shelf.close()
+        self.shelf = dirshelve.open(TEST_DIR, serializer=serializers.Store('pickle'))
+        self.assertEqual(self.shelf['test2'], {'b': [3, 4]})
+        
+        # but marshal is only ever a store's default
+        self.assertRaises(ValueError, serializers.Store, 'marshal', 'pickle')
+        with open(TEST_DIR + '/test3', 'wb') as f:
+            f.write(serializers.HEADER + '\x01' + marshal.dumps('three'))
+        self.assertRaises(Exception, self.shelf.__getitem__, 'test3')
+        
+class DirShelveFanoutTest(DirShelveTest):
+    
+    def setUp(self):
+        self.shelf = dirshelve.open(TEST_DIR, fanout=2)
+        
+    def test_set(self):
+        self.shelf['test1'] = 'one'
+        self.shelf['test/test2'] = 'two'
+        
+        path = self.shelf._key_path('test/test2')
+        self.assertEqual(path[len(self.shelf.dirname):].count('/'), 3)
+        self.assertTrue(path.endswith('/test%2Ftest2'))
+        self.assertEqual(open(path, 'rb').read(), dirshelve.pickle.dumps('two', pickle.HIGHEST_PROTOCOL))
+        
+        # layout is kept if reopened without fanout
+        self.shelf.close()
+        self.shelf = dirshelve.open(TEST_DIR)
+        self.assertEqual(self.shelf.fanout, 2)
+        self.assertEqual(self.shelf['test/test2'], 'two')
+        
+    def test_delete(self):
+        self.shelf['test1'] = 'one'
+        
+        del(self.shelf['test1'])
+        self.assertFalse('test1' in self.shelf)
+        
+        with self.assertRaises(KeyError):
+            del(self.shelf['test2'])
+    
+    def test_manifest(self):
+        for i in range(10):
+            self.shelf['test{0}'.format(i)] = i
+        del(self.shelf['test3'])
+        self.shelf.close()
+        
+        # keys come from the manifest rather than walking the tree
+        self.setUp()
+        self.shelf._walk = None
+        self.assertEqual(len(self.shelf), 9)
+        self.assertTrue('test4' in self.shelf)
+        self.assertFalse('test3' in self.shelf)
+        self.assertEqual(sorted(self.shelf), sorted('test{0}'.format(i) for i in range(10) if i != 3))
+        
+        # a lost manifest is rebuilt from the files
+        self.shelf.close()
+        os.unlink(os.path.join(TEST_DIR, dirshelve.MANIFEST))
+        self.setUp()
+        self.assertEqual(self.shelf.fanout, 2)
+        self.assertEqual(len(self.shelf), 9)
+        self.assertEqual(self.shelf['test4'], 4)
+        
+        # and the layout is found from the files too
+        self.shelf.close()
+        os.unlink(os.path.join(TEST_DIR, dirshelve.MANIFEST))
+        self.shelf = dirshelve.open(TEST_DIR)
+        self.assertEqual(self.shelf.fanout, 2)
+        self.assertEqual(sorted(self.shelf), sorted('test{0}'.format(i) for i in range(10) if i != 3))
+        
+        # the manifest is only opened for writing on a change
+        self.shelf.close()
+        self.setUp()
+        self.assertEqual(self.shelf['test4'], 4)
+        self.assertEqual(self.shelf._log, None)
+        self.shelf['test3'] = 3
+        self.assertFalse(self.shelf._log is None)
+        
 if __name__ == '__main__':
     #import logging
     #logging.basicConfig(level=logging.DEBUG)
@@ -1,9 +1,15 @@
 import unittest
-import os, shutil, sys, getpass
+import os, shutil, sys, getpass, json, logging
 
 import pyissues
 from pyissues import PyIssues, PyIssuesException
 
+def load_script():
+    import imp
+    script = imp.load_source('pyissues_script', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts', 'pyissues'))
+    script.load()
+    return script
+
 class TestPyIssues(unittest.TestCase):
     
     TEST_DIR = '/tmp/issues'
@@ -51,9 +57,26 @@ class TestPyIssues(unittest.TestCase):
         self.assertEqual(self.issues.match(uuid[0:3]), path)
         
         # check for errors if multiple matches
-        open(path + "_", 'w').close()
+        self.issues.update(self.issues.create(description="Test 2", uuid=uuid + "_"))
         with self.assertRaisesRegexp(PyIssuesException, "Multiple matches for {0} - be more specific".format(uuid[0:3])):
             self.issues.match(uuid[0:3])
+    
+    def test_match_fallback(self):
+        issue = self.issues.create(description="Test 1")
+        self.issues.update(issue)
+        path = "{0}/objs/{1}".format(self.TEST_DIR, issue.uuid)
+        
+        # resolved from the index
+        self.assertEqual(self.issues.uuid_index.matches(issue.uuid[:4]), [issue.uuid])
+        self.assertEqual(self.issues.match(issue.uuid[:4]), path)
+        
+        # objects not in the index are still found on disk
+        open(path + "_", 'w').close()
+        self.assertEqual(self.issues.match(issue.uuid + "_"), path + "_")
+        
+        # stale index entries fall back to the filesystem
+        os.unlink(path)
+        self.assertEqual(self.issues.match(issue.uuid[:4]), path + "_")
             
     def test_index(self):
         issue = self.issues.create(description='Test 1')
@@ -63,6 +86,462 @@ class TestPyIssues(unittest.TestCase):
         self.assertEqual(index['comments'], 0)
         self.assertEqual(index['assigned'], 'no-one')
             
+    def test_records(self):
+        issue = self.issues.create(description='Test 1', extra='value')
+        self.assertFalse('description' in issue.__dict__)
+        self.assertEqual(issue.__dict__, {'extra': 'value'})
+        self.assertEqual(issue.as_dict()['extra'], 'value')
+        self.assertEqual(type(issue), type(self.issues.create(description='Test 2')))
+        self.issues.update(issue)
+        
+        row = self.issues.filter()[0]
+        self.assertTrue(isinstance(row, tuple))
+        self.assertEqual(row['description'], 'Test 1')
+        self.assertEqual(row.description, 'Test 1')
+        self.assertEqual(row.get('foo'), None)
+        self.assertEqual(row.as_dict(), pyissues.Issue.expand_index(issue.uuid, self.issues.issues_data[issue.uuid], self.issues.settings['_index']))
+        with self.assertRaises(KeyError):
+            row['foo']
+        
+        # still usable where a dict was
+        self.assertTrue('status' in row)
+        self.assertFalse('foo' in row)
+        self.assertEqual(row, row.as_dict())
+        self.assertEqual(dict(row), row.as_dict())
+        self.assertNotEqual(row, dict(row.as_dict(), status='closed'))
+        self.assertEqual(json.loads(json.dumps(row.as_dict()))['description'], 'Test 1')
+        
+    def test_sort_limit(self):
+        for i, p in enumerate([ 'low', 'high', 'blocker', 'high', 'medium' ]):
+            self.issues.update(self.issues.create(description="Test {0}".format(i), priority=p,
+                                                  created='2000-01-0{0}'.format(i + 1)))
+        
+        # options sort alphabetically unless ranked
+        self.assertFieldEqual(self.issues.filter(sort='priority,created'), 'description',
+                              ['Test 2', 'Test 1', 'Test 3', 'Test 0', 'Test 4'])
+        
+        # ranked options sort in their declared order, ties broken by the next key
+        self.issues.settings['_ranked'] = ('priority', )
+        self.assertFieldEqual(self.issues.filter(sort='-priority,created'), 'description',
+                              ['Test 2', 'Test 1', 'Test 3', 'Test 4', 'Test 0'])
+        self.assertFieldEqual(self.issues.filter(sort='-priority,-created', limit=3), 'description',
+                              ['Test 2', 'Test 3', 'Test 1'])
+        self.assertFieldEqual(self.issues.filter(sort='priority,created', limit=2, offset=1), 'description',
+                              ['Test 4', 'Test 1'])
+        
+        # presorted index
+        self.assertFieldEqual(self.issues.filter(sort='-created', limit=2), 'description',
+                              ['Test 4', 'Test 3'])
+        self.assertFieldEqual(self.issues.filter(lambda x: x['priority'] == 'high', sort='created', limit=1), 'description',
+                              ['Test 1'])
+        
+        items = self.issues.filter({'priority': 'high'}, sort='created', iterator=True)
+        self.assertFalse(isinstance(items, list))
+        self.assertFieldEqual(list(items), 'description', ['Test 1', 'Test 3'])
+        
+        # indexed filters walk the presorted index when they match enough rows
+        index = self.issues.sorted_index['created']
+        walked = []
+        uuids = index.uuids
+        index.uuids = lambda reverse=False: walked.append(reverse) or uuids(reverse)
+        self.assertFieldEqual(self.issues.filter({'status': 'open'}, sort='-created', limit=2), 'description',
+                              ['Test 4', 'Test 3'])
+        self.assertEqual(walked, [True])
+        self.assertFieldEqual(self.issues.filter({'priority': 'blocker'}, sort='-created', limit=2), 'description',
+                              ['Test 2'])
+        self.assertEqual(walked, [True])
+        del(index.uuids)
+        
+        # sorted again after a reload rather than saved, and only when read
+        self.issues.flush()
+        self.assertFalse(os.path.exists(os.path.join(self.TEST_DIR, 'sorted.db')))
+        issues = PyIssues(self.TEST_DIR)
+        issues.update(issues.create(description='Test 5', created='2000-01-06'))
+        self.assertEqual(issues.sorted_index['created'].entries, [])
+        self.assertFieldEqual(issues.filter(sort='created', limit=2, offset=3), 'description',
+                              ['Test 3', 'Test 4'])
+        self.assertEqual(len(issues.sorted_index['created'].entries), 6)
+        
+    def test_query(self):
+        from pyissues import query
+        
+        for i, (p, a) in enumerate([ ('low', 'no-one'), ('high', 'bob'), ('blocker', 'no-one'), ('high', 'alice'), ('medium', 'bob') ]):
+            self.issues.update(self.issues.create(description="Test {0}".format(i), priority=p, assigned=a,
+                                                  created='2000-01-0{0} 12:00:00'.format(i + 1)))
+        
+        def check(q, expected, **kwargs):
+            self.assertFieldEqual(self.issues.filter(q, sort='created', **kwargs), 'description',
+                                  [ 'Test {0}'.format(x) for x in expected ])
+        
+        check('priority in (high, blocker) and created >= 2000-01-03 and assigned != no-one', [3])
+        # options compare as text unless ranked
+        check('priority >= high', [0, 1, 3, 4])
+        check('priority > urgent', [])
+        self.issues.settings['_ranked'] = ('priority', )
+        check('priority >= high', [1, 2, 3])
+        self.assertRaises(query.QueryError, self.issues.filter, 'priority > urgent')
+        check('not (priority = high or assigned = "no-one")', [4])
+        check('created >= 2000-01-03 and created < 2000-01-05', [2, 3])
+        check('created < 2000-01-03 or description ~ "TEST 4"', [0, 1, 4])
+        check('comments = 0 and uuid not in (x, y)', [0, 1, 2], limit=3)
+        
+        # planned from the indexes, the predicate isn't needed for every row
+        q = query.parse('priority = high and created <= 2000-01-03')
+        self.assertEqual(len(q.candidates(self.issues.field_index, self.issues.sorted_index, self.issues.settings, self.issues.issues_data)), 1)
+        self.assertEqual(query.parse('priority = high or not assigned = bob').candidates(
+            self.issues.field_index, self.issues.sorted_index, self.issues.settings, self.issues.issues_data), None)
+        
+        # a selective query sorts its few candidates rather than walking the sorted index
+        index = self.issues.sorted_index['created']
+        walked = []
+        uuids = index.uuids
+        index.uuids = lambda reverse=False: walked.append(reverse) or uuids(reverse)
+        self.assertFieldEqual(self.issues.filter('priority = blocker', sort='-created', limit=1), 'description', ['Test 2'])
+        self.assertEqual(walked, [])
+        self.assertFieldEqual(self.issues.filter('priority != blocker', sort='-created', limit=1), 'description', ['Test 4'])
+        self.assertEqual(walked, [True])
+        del(index.uuids)
+        
+        for bad in ('priority =', 'colour = red', '(status = open', 'status = open and'):
+            self.assertRaises(query.QueryError, self.issues.filter, bad)
+        
+    def test_server(self):
+        from pyissues import server
+        
+        def dispatch(issues, action, args):
+            print action, len(issues.filter(*args))
+            pyissues.logger.info("Ran %s for %s", action, pyissues.conf._user())
+            return 3
+        
+        s = server.Server(self.issues, dispatch)
+        root = logging.getLogger()
+        level = root.level
+        root.setLevel(logging.INFO)
+        try:
+            self.assertEqual(s.handle({'action': 'list'}), {'output': 'list 0\n', 'status': 3,
+                                                            'log': 'INFO:pyissues:Ran list for {0}\n'.format(pyissues.conf._user())})
+            
+            # run as the caller, with their log level
+            response = s.handle({'action': 'list', 'user': 'zed', 'level': logging.WARNING})
+            self.assertEqual((response['output'], response['log']), ('list 0\n', ''))
+            self.assertEqual(s.handle({'action': 'list', 'user': 'zed'})['log'], 'INFO:pyissues:Ran list for zed\n')
+            self.assertNotEqual(pyissues.conf._user(), 'zed')
+        finally:
+            root.setLevel(level)
+        
+        # an object file arriving from elsewhere e.g. a git pull
+        issue = self.issues.create(description='Test 1')
+        with open(os.path.join(self.issues.obj_dir, issue.uuid), 'w') as f:
+            issue.write(f)
+        self.assertEqual(s.handle({'action': 'list'})['output'], 'list 1\n')
+        
+        # the database written by another process
+        other = PyIssues(self.TEST_DIR)
+        other.update(other.create(description='Test 2'))
+        other.close()
+        self.assertEqual(s.handle({'action': 'list'})['output'], 'list 2\n')
+        
+    def test_async(self):
+        from pyissues.aio import AsyncPyIssues
+        
+        issues = AsyncPyIssues(self.issues, workers=4)
+        created = [ self.issues.create(description="Test {0}".format(i)) for i in range(20) ]
+        self.assertEqual(issues.update_many(created).get(), created)
+        
+        result = issues.get_many([ x.uuid[:8] for x in reversed(created) ])
+        self.assertEqual([ x.description for x in result.get() ], [ "Test {0}".format(i) for i in range(19, -1, -1) ])
+        
+        self.assertEqual(len(issues.filter({'status': 'open'}, limit=5).get()), 5)
+        
+        with self.assertRaises(PyIssuesException):
+            issues.get_many(['zzz']).get()
+        
+        # concurrent updates of one issue leave its object matching its row
+        versions = [ self.issues.get(created[0].uuid) for i in range(20) ]
+        for i, issue in enumerate(versions):
+            issue.description = "Version {0}".format(i)
+        issues.update_many(versions).get()
+        self.assertEqual(self.issues.get(created[0].uuid).description, self.issues.row(created[0].uuid)['description'])
+        
+        issues.close()
+        self.assertEqual(len(PyIssues(self.TEST_DIR).filter()), 20)
+        
+    def test_merge_on_flush(self):
+        first = self.issues.create(description='Test 0')
+        self.issues.update(first)
+        self.issues.flush()
+        
+        a, b = PyIssues(self.TEST_DIR), PyIssues(self.TEST_DIR)
+        self.assertEqual(len(a.filter()), 1)
+        self.assertEqual(len(b.filter()), 1)
+        self.assertEqual(len(a.search('test')), 1)
+        self.assertEqual(len(b.search('test')), 1)
+        
+        a.update(a.create(description='Test apple'))
+        b.update(b.create(description='Test banana'))
+        b.delete(first.uuid)
+        a.close()
+        b.close()
+        
+        issues = PyIssues(self.TEST_DIR)
+        self.assertEqual(sorted(x['description'] for x in issues.filter()), ['Test apple', 'Test banana'])
+        self.assertEqual(len(issues.filter({'status': 'open'})), 2)
+        self.assertEqual(len(issues.search('apple')), 1)
+        self.assertEqual(len(issues.search('banana')), 1)
+        self.assertEqual(len(issues.search('test')), 2)
+        
+        # a write of the same size in the same tick is still merged
+        a, b = PyIssues(self.TEST_DIR), PyIssues(self.TEST_DIR)
+        os.utime(a.issues_file, (1000000000, 1000000000))
+        self.assertEqual(len(a.filter()), 2)
+        before = os.stat(a.issues_file)
+        issue = b.get(b.filter({'description': 'Test apple'})[0]['uuid'])
+        issue.description = 'Test grape'
+        b.update(issue, touch=False)
+        b.close()
+        self.assertEqual(os.stat(a.issues_file).st_size, before.st_size)
+        os.utime(a.issues_file, (before.st_atime, before.st_mtime))
+        a.update(a.create(description='Test cherry'))
+        a.close()
+        issues = PyIssues(self.TEST_DIR)
+        self.assertEqual(sorted(x['description'] for x in issues.filter()), ['Test banana', 'Test cherry', 'Test grape'])
+        
+    def test_stats(self):
+        for i, (a, p) in enumerate([ ('bob', 'low'), ('bob', 'high'), ('jim', 'high'), ('no-one', 'high') ]):
+            self.issues.update(self.issues.create(description="Test {0}".format(i), assigned=a, priority=p))
+        
+        self.assertEqual(self.issues.stats('assigned'), {'bob': 2, 'jim': 1, 'no-one': 1})
+        self.assertEqual(self.issues.stats('status', 'assigned'), {('open', 'bob'): 2, ('open', 'jim'): 1, ('open', 'no-one'): 1})
+        self.assertEqual(self.issues.stats('assigned', 'status'), {('bob', 'open'): 2, ('jim', 'open'): 1, ('no-one', 'open'): 1})
+        # not aggregated so counted from the field index, or scanned
+        self.assertEqual(self.issues.stats('assigned', 'priority', 'description'), {('bob', 'low', 'Test 0'): 1, ('bob', 'high', 'Test 1'): 1,
+                                                                             ('jim', 'high', 'Test 2'): 1, ('no-one', 'high', 'Test 3'): 1})
+        self.assertEqual(self.issues.stats('assigned', 'priority'), {('bob', 'low'): 1, ('bob', 'high'): 1, ('jim', 'high'): 1, ('no-one', 'high'): 1})
+        # the comment and attachment counts are at the end of the rows
+        self.assertEqual(self.issues.stats('comments'), {0: 4})
+        self.assertEqual(self.issues.stats('status', 'attachments'), {('open', 0): 4})
+        
+        issue = self.issues.get(self.issues.filter({'assigned': 'jim'})[0]['uuid'])
+        issue.status = 'closed'
+        self.issues.update(issue)
+        self.issues.delete(self.issues.filter({'assigned': 'no-one'})[0]['uuid'])
+        self.issues.flush()
+        
+        # saved with the database so answered without loading it
+        issues = PyIssues(self.TEST_DIR)
+        self.assertEqual(issues.stats('status', 'assigned'), {('open', 'bob'): 2, ('closed', 'jim'): 1})
+        self.assertEqual(issues.stats('assigned'), {'bob': 2, 'jim': 1})
+        self.assertEqual(issues._issues_data, None)
+        
+        # and counted again if the database has changed since
+        other = PyIssues(self.TEST_DIR)
+        other.update(other.create(description='Test 4', assigned='jim'))
+        other.rebuild()
+        other.close()
+        self.assertEqual(issues.stats('status', 'assigned'), {('open', 'bob'): 2, ('closed', 'jim'): 1, ('open', 'jim'): 1})
+        issues = PyIssues(self.TEST_DIR)
+        issues.delete(issues.filter({'description': 'Test 4'})[0]['uuid'])
+        issues.flush()
+        issues = PyIssues(self.TEST_DIR)
+        self.assertEqual(issues.stats('status', 'assigned'), {('open', 'bob'): 2, ('closed', 'jim'): 1})
+        self.assertEqual(issues._issues_data, None)
+        
+        # kept up to date once counted
+        issue = issues.get(issues.filter({'assigned': 'jim'})[0]['uuid'])
+        issue.assigned = 'bob'
+        issues.update(issue)
+        self.assertEqual(issues.stats('status', 'assigned'), {('open', 'bob'): 2, ('closed', 'bob'): 1})
+        issue.assigned = 'jim'
+        issues.update(issue)
+        issues.rebuild()
+        self.assertEqual(issues.stats('status', 'assigned'), {('open', 'bob'): 2, ('closed', 'jim'): 1})
+        
+        with self.assertRaises(PyIssuesException):
+            issues.stats('foo')
+        
+    def test_pack(self):
+        created = [ self.issues.create(description="Test {0}".format(i), status=s) for i, s in enumerate(['open', 'closed', 'archived', 'closed']) ]
+        for issue in created:
+            self.issues.update(issue)
+        created[3].updated = '2000-01-01 00:00:00'
+        self.issues.update(created[3], touch=False)
+        self.issues.flush()
+        
+        self.assertEqual(self.issues.pack(), 2)
+        self.assertEqual(sorted(os.listdir(self.issues.obj_dir)), sorted([ x.uuid for x in created[:2] ]))
+        self.assertEqual(self.issues.pack(days=0), 1)
+        self.assertEqual(os.listdir(self.issues.obj_dir), [ created[0].uuid ])
+        
+        # packed issues can still be found
+        self.assertEqual(self.issues.get(created[2].uuid[:8]).description, 'Test 2')
+        self.assertEqual(self.issues.get(created[3].uuid[:8]).description, 'Test 3')
+        self.assertEqual(len(list(self.issues.iter_issues())), 4)
+        
+        # and are read by rebuild
+        issues = PyIssues(self.TEST_DIR)
+        self.assertEqual(issues.rebuild(), 4)
+        self.assertEqual(sorted(x['description'] for x in issues.filter()), ['Test 0', 'Test 1', 'Test 3'])
+        issues.flush()
+        self.assertEqual(issues.rebuild(incremental=True), 0)
+        
+        # updates are written loose and win over the packed copy
+        issue = issues.get(created[3].uuid)
+        issue.description = 'Test 3 again'
+        issues.update(issue)
+        self.assertEqual(issues.get(created[3].uuid).description, 'Test 3 again')
+        self.assertFalse(created[3].uuid in issues.packs)
+        self.assertTrue(created[2].uuid in issues.packs)
+        
+        # stubs are ambiguous across loose and packed issues
+        stub = created[2].uuid[:8]
+        with open('{0}/{1}x'.format(issues.obj_dir, stub), 'w') as f:
+            issues.create(description='Loose', uuid=stub + 'x').write(f)
+        with self.assertRaises(PyIssuesException):
+            issues.match(stub)
+        os.unlink('{0}/{1}x'.format(issues.obj_dir, stub))
+        issues.update(issues.create(description='Indexed', uuid=stub + 'y'))
+        with self.assertRaises(PyIssuesException):
+            issues.match(stub)
+        issues.delete(stub + 'y')
+        self.assertEqual(issues.match(stub), '{0}/{1}'.format(issues.obj_dir, created[2].uuid))
+        
+        issues.delete(created[3].uuid)
+        issues.delete(created[2].uuid)
+        self.assertFalse(created[3].uuid in issues.packs)
+        self.assertFalse(created[2].uuid in issues.packs)
+        with self.assertRaises(PyIssuesException):
+            issues.get(created[3].uuid)
+        issues.close()
+        
+    def test_instrument(self):
+        from pyissues import instrument
+        import dirshelve
+        
+        issue = self.issues.create(description='Test 1')
+        self.issues.update(issue)
+        self.issues.flush()
+        self.assertEqual(instrument.timers, {})
+        
+        instrument.enable()
+        try:
+            issues = PyIssues(self.TEST_DIR)
+            issues.get(issue.uuid[:8])
+            issues.filter(sort='-priority')
+            d = dirshelve.open(os.path.join(self.TEST_DIR, 'shelf'))
+            d['test'] = 'value'
+            d.close()
+        finally:
+            instrument.disable()
+        
+        for name in ('get', 'match', 'filter', 'sort', 'load database'):
+            self.assertEqual(instrument.timers[name][0], 1, name)
+        self.assertTrue('dirshelf write' in instrument.timers)
+        self.assertEqual(instrument.counters['objects parsed'], 1)
+        self.assertEqual(instrument.counters['dirshelf files written'], 1)
+        self.assertTrue(instrument.counters['bytes read'] > 0)
+        
+        # nothing more once disabled
+        issues.get(issue.uuid)
+        self.assertEqual(instrument.timers['get'][0], 1)
+        
+    def test_git_refresh(self):
+        import subprocess
+        def git(*args):
+            with open(os.devnull, 'w') as null:
+                subprocess.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args),
+                                      cwd=self.TEST_DIR, stdout=null, stderr=null)
+        
+        created = [ self.issues.create(description="Test {0}".format(i)) for i in range(3) ]
+        for issue in created:
+            self.issues.update(issue)
+        self.issues.close()
+        git('init')
+        git('add', 'objs')
+        git('commit', '-m', 'First')
+        PyIssues(self.TEST_DIR).close()
+        head = pyissues.vcs.head(pyissues.vcs.find_git_dir(self.TEST_DIR))
+        with open(os.path.join(self.TEST_DIR, 'git.db')) as f:
+            self.assertEqual(json.load(f)['head'], head)
+        
+        # someone else changes the objects
+        created[0].description = 'Test 0 changed'
+        with open(os.path.join(self.TEST_DIR, 'objs', created[0].uuid), 'w') as f:
+            created[0].write(f)
+        os.unlink(os.path.join(self.TEST_DIR, 'objs', created[1].uuid))
+        added = self.issues.create(description='Test 3')
+        with open(os.path.join(self.TEST_DIR, 'objs', added.uuid), 'w') as f:
+            added.write(f)
+        git('add', '-A', 'objs')
+        git('commit', '-m', 'Second')
+        
+        issues = PyIssues(self.TEST_DIR)
+        self.assertEqual(sorted(x['description'] for x in issues.filter()), ['Test 0 changed', 'Test 2', 'Test 3'])
+        self.assertEqual(len(issues.search('changed')), 1)
+        issues.close()
+        
+        # the new head is recorded so nothing is reapplied
+        issues = PyIssues(self.TEST_DIR)
+        self.assertEqual(issues._delta, {})
+        self.assertEqual(len(issues.filter()), 3)
+        
+        # committing our own changes doesn't need them applying again
+        issue = issues.get(created[2].uuid)
+        issue.description = 'Test 2 changed'
+        issues.update(issue)
+        git('add', '-A', 'objs')
+        git('commit', '-m', 'Third')
+        issues.git_committed()
+        issues.close()
+        issues = PyIssues(self.TEST_DIR)
+        self.assertEqual((issues._delta, issues.dirty), ({}, False))
+        
+        # a head that can't be diffed isn't replaced until the index catches up
+        with open(os.path.join(self.TEST_DIR, 'git.db'), 'w') as f:
+            json.dump({'head': '0' * 40}, f)
+        issues = PyIssues(self.TEST_DIR)
+        issues.update(issues.get(created[2].uuid))
+        issues.close()
+        with open(os.path.join(self.TEST_DIR, 'git.db')) as f:
+            self.assertEqual(json.load(f)['head'], '0' * 40)
+        
+    def test_save(self):
+        import subprocess
+        env = dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+                   GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com')
+        def git(*args, **kwargs):
+            with open(os.devnull, 'w') as null:
+                subprocess.check_call(['git'] + list(args), cwd=kwargs.get('cwd', self.TEST_DIR), env=env, stdout=null, stderr=null)
+        
+        created = [ self.issues.create(description="Test {0}".format(i), status=s) for i, s in enumerate(['open', 'closed']) ]
+        for issue in created:
+            self.issues.update(issue)
+        git('init')
+        self.assertEqual(self.issues.pack(days=0), 1)
+        
+        script = load_script()
+        saved = dict(os.environ)
+        os.environ.update(env)
+        # git's output goes straight to the file descriptor
+        stdout, null = os.dup(1), os.open(os.devnull, os.O_WRONLY)
+        os.dup2(null, 1)
+        try:
+            script.action_save(self.issues)
+        finally:
+            os.dup2(stdout, 1)
+            os.close(stdout)
+            os.close(null)
+            os.environ.clear()
+            os.environ.update(saved)
+        self.issues.close()
+        
+        # a clone has the packed issue as well as the loose one
+        clone = os.path.join(self.TEST_DIR, 'clone')
+        git('clone', self.TEST_DIR, clone)
+        issues = PyIssues(clone)
+        self.assertEqual(issues.rebuild(), 2)
+        self.assertEqual(issues.get(created[1].uuid).description, 'Test 1')
+        issues.close()
+        
     def test_filters(self):
         for i in [ 'AA', 'AB', 'BC' ]:
             self.issues.update(self.issues.create(description="Test {0}".format(i)))
@@ -94,6 +573,475 @@ class TestPyIssues(unittest.TestCase):
                               ['Test AB', 'Test AA'])
         
         
+    def test_field_index(self):
+        for i, status in [ ('A', 'open'), ('B', 'closed'), ('C', 'open') ]:
+            self.issues.update(self.issues.create(description="Test {0}".format(i), status=status, assigned=i))
+        
+        self.assertEqual(len(self.issues.field_index.lookup('status', 'open')), 2)
+        
+        self.assertFieldEqual(self.issues.filter({'status': 'open'}, 'description'), 'description',
+                              ['Test A', 'Test C'])
+        self.assertFieldEqual(self.issues.filter({'status': 'open', 'assigned': 'C'}, 'description'), 'description',
+                              ['Test C'])
+        self.assertFieldEqual(self.issues.filter({'status': 'open', 'description': 'Test A'}, 'description'), 'description',
+                              ['Test A'])
+        
+        # postings follow updates
+        issue = self.issues.get(self.issues.filter({'assigned': 'B'})[0]['uuid'])
+        issue.status = 'open'
+        self.issues.update(issue)
+        self.assertEqual(len(self.issues.field_index.lookup('status', 'open')), 3)
+        self.assertEqual(self.issues.field_index.lookup('status', 'closed'), set())
+        
+        self.issues.delete(issue.uuid)
+        self.assertFieldEqual(self.issues.filter({'status': 'open'}, 'description'), 'description',
+                              ['Test A', 'Test C'])
+        
+        # built from the database when first used rather than saved
+        self.issues.close()
+        self.issues = PyIssues(self.TEST_DIR)
+        self.assertEqual(len(self.issues.field_index.lookup('status', 'open')), 2)
+        self.assertFalse(self.issues.dirty)
+        self.assertFalse(os.path.exists(os.path.join(self.TEST_DIR, 'fields.db')))
+        
+    def test_rebuild(self):
+        uuids = []
+        for i in [ 'A', 'B', 'C' ]:
+            issue = self.issues.create(description="Test {0}".format(i))
+            self.issues.update(issue)
+            uuids.append(issue.uuid)
+        expected = self.issues.filter(sort='description')
+        
+        self.assertEqual(self.issues.rebuild(), 3)
+        self.assertEqual(self.issues.filter(sort='description'), expected)
+        self.issues.flush()
+        
+        # nothing changed
+        self.assertEqual(self.issues.rebuild(incremental=True), 0)
+        self.assertEqual(self.issues.filter(sort='description'), expected)
+        
+        # archive one and remove another behind the index's back
+        issue = self.issues.get(uuids[0])
+        issue.status = 'archived'
+        issue.write(open("{0}/objs/{1}".format(self.TEST_DIR, issue.uuid), 'w'))
+        os.unlink("{0}/objs/{1}".format(self.TEST_DIR, uuids[1]))
+        
+        self.assertEqual(self.issues.rebuild(incremental=True), 1)
+        self.assertFieldEqual(self.issues.filter(sort='description'), 'description', ['Test C'])
+        self.assertEqual(self.issues.field_index.lookup('status', 'open'), set([uuids[2]]))
+        self.assertEqual(self.issues.uuid_index.uuids, [uuids[2]])
+        
+        # created after the last rebuild then removed e.g. by a git checkout
+        issue = self.issues.create(description="Test D gone")
+        self.issues.update(issue)
+        self.issues.flush()
+        os.unlink("{0}/objs/{1}".format(self.TEST_DIR, issue.uuid))
+        self.assertEqual(self.issues.rebuild(incremental=True), 0)
+        self.assertFieldEqual(self.issues.filter(sort='description'), 'description', ['Test C'])
+        self.assertEqual(self.issues.search('gone'), [])
+        
+        # parallel parsing gives the same result
+        self.assertEqual(self.issues.rebuild(jobs=2), 2)
+        self.assertFieldEqual(self.issues.filter(sort='description'), 'description', ['Test C'])
+        
+    def test_columnar(self):
+        for i in [ 'A', 'B', 'C' ]:
+            self.issues.update(self.issues.create(description=u"Test {0} \u00e9".format(i), status='closed' if i == 'B' else 'open'))
+        expected = self.issues.filter(sort='description')
+        
+        self.assertTrue(self.issues.convert('columnar'))
+        self.issues.close()
+        
+        self.issues = PyIssues(self.TEST_DIR)
+        self.assertEqual(self.issues.storage, 'columnar')
+        self.assertEqual(len(self.issues.issues_data), 3)
+        self.assertEqual(self.issues.filter(sort='description'), expected)
+        self.assertEqual(list(self.issues.issues_data.column('status')), [ x['status'] for x in sorted(expected, key=lambda x: x['uuid']) ])
+        
+        # rows are decoded a cell at a time
+        row = self.issues.issues_data[expected[1]['uuid']]
+        self.assertEqual(row[1], 'closed')
+        self.assertEqual(row, [ expected[1][x] for x in self.issues.settings['_index'] + ('comments', 'attachments') ])
+        
+        # changes are kept over the mapped file until saved
+        issue = self.issues.get(expected[0]['uuid'])
+        issue.status = 'closed'
+        self.issues.update(issue)
+        self.issues.delete(expected[2]['uuid'])
+        self.assertFieldEqual(self.issues.filter({'status': 'closed'}, 'description'), 'description',
+                              [u'Test A \u00e9', u'Test B \u00e9'])
+        data = self.issues.issues_data
+        self.issues.close()
+        
+        # the mapping is released on close
+        self.assertRaises(ValueError, data._buf.read, 1)
+        
+        self.issues = PyIssues(self.TEST_DIR)
+        self.assertEqual(len(self.issues.issues_data), 2)
+        self.assertFieldEqual(self.issues.filter({'status': 'closed'}, 'description'), 'description',
+                              [u'Test A \u00e9', u'Test B \u00e9'])
+        
+        # and back again
+        self.issues.convert('json')
+        self.issues.close()
+        self.issues = PyIssues(self.TEST_DIR)
+        self.assertEqual(self.issues.storage, 'json')
+        self.assertEqual(type(self.issues.issues_data), dict)
+        self.assertEqual(len(self.issues.filter()), 2)
+        
+    def test_lazy_load(self):
+        uuids = []
+        for i in [ 'A', 'B', 'C' ]:
+            issue = self.issues.create(description="Test {0}".format(i))
+            self.issues.update(issue)
+            uuids.append(issue.uuid)
+        self.issues.close()
+        
+        self.issues = PyIssues(self.TEST_DIR)
+        issue = self.issues.get(uuids[0][:6])
+        self.assertEqual(issue.description, 'Test A')
+        
+        # changes are held as a delta
+        issue.status = 'closed'
+        self.issues.update(issue)
+        self.issues.delete(uuids[1][:6])
+        new = self.issues.create(description='Test D')
+        self.issues.update(new)
+        self.assertEqual(self.issues.match(new.uuid[:6]), "{0}/objs/{1}".format(self.TEST_DIR, new.uuid))
+        self.assertIsNone(self.issues._issues_data)
+        self.assertEqual(len(self.issues._delta), 3)
+        
+        self.assertTrue(self.issues.flush())
+        self.assertEqual(self.issues._delta, {})
+        self.assertFieldEqual(self.issues.filter(sort='description'), 'description', ['Test A', 'Test C', 'Test D'])
+        self.assertEqual(self.issues.filter({'status': 'closed'})[0]['uuid'], uuids[0])
+        
+        # pending changes are applied if the database gets loaded
+        self.issues.close()
+        self.issues = PyIssues(self.TEST_DIR)
+        self.issues.delete(uuids[2])
+        self.assertFieldEqual(self.issues.filter(sort='description'), 'description', ['Test A', 'Test D'])
+        
+    def test_transaction(self):
+        existing = self.issues.create(description='Test A')
+        self.issues.update(existing)
+        self.issues.flush()
+        
+        with self.issues.transaction():
+            for i in [ 'B', 'C' ]:
+                self.issues.update(self.issues.create(description="Test {0}".format(i)))
+            
+            # nothing written until commit, but pending changes are visible
+            self.assertTrue(os.path.exists(self.issues.journal_file))
+            self.assertEqual(len(os.listdir(self.issues.obj_dir)), 1)
+            self.assertFalse(self.issues.flush())
+            
+            issue = self.issues.get(existing.uuid)
+            issue.status = 'closed'
+            self.issues.update(issue)
+            self.assertEqual(self.issues.get(existing.uuid[:6]).status, 'closed')
+        
+        self.assertFalse(os.path.exists(self.issues.journal_file))
+        self.assertEqual(len(os.listdir(self.issues.obj_dir)), 3)
+        self.assertFalse(self.issues.dirty)
+        self.assertEqual(PyIssues(self.TEST_DIR).get(existing.uuid).status, 'closed')
+        
+        # errors roll everything back
+        with self.assertRaises(ValueError):
+            with self.issues.transaction():
+                self.issues.delete(existing.uuid)
+                self.issues.update(self.issues.create(description='Test D'))
+                raise ValueError()
+        
+        self.assertFalse(os.path.exists(self.issues.journal_file))
+        self.assertFieldEqual(self.issues.filter(sort='description'), 'description', ['Test A', 'Test B', 'Test C'])
+        self.assertEqual(len(os.listdir(self.issues.obj_dir)), 3)
+        
+        # apart from changes already checkpointed
+        with self.assertRaises(ValueError):
+            with self.issues.transaction():
+                self.issues.update(self.issues.create(description='Test D'))
+                self.issues.checkpoint()
+                self.assertEqual(len(os.listdir(self.issues.obj_dir)), 4)
+                self.assertFalse(self.issues.flush())
+                self.issues.update(self.issues.create(description='Test E'))
+                raise ValueError()
+        
+        self.assertFalse(os.path.exists(self.issues.journal_file))
+        self.assertFieldEqual(self.issues.filter(sort='description'), 'description', ['Test A', 'Test B', 'Test C', 'Test D'])
+        self.assertFieldEqual(PyIssues(self.TEST_DIR).filter(sort='description'), 'description', ['Test A', 'Test B', 'Test C', 'Test D'])
+        self.assertEqual(len(os.listdir(self.issues.obj_dir)), 4)
+        
+        with self.assertRaisesRegexp(PyIssuesException, "No transaction"):
+            self.issues.checkpoint()
+        
+        # changes made before the transaction aren't lost with it
+        issue = self.issues.get(existing.uuid)
+        issue.description = 'Test A zebra'
+        self.issues.update(issue)
+        with self.assertRaises(ValueError):
+            with self.issues.transaction():
+                self.issues.update(self.issues.create(description='Test E zebra'))
+                raise ValueError()
+        self.assertFieldEqual([ x for x, score in self.issues.search('zebra') ], 'description', ['Test A zebra'])
+        self.issues.close()
+        self.assertFieldEqual([ x for x, score in PyIssues(self.TEST_DIR).search('zebra') ], 'description', ['Test A zebra'])
+        
+    def test_journal_replay(self):
+        issue = self.issues.create(description='Test A')
+        entry = json.dumps({'uuid': issue.uuid, 'data': issue.as_dict()})
+        
+        # uncommitted journals are thrown away
+        with open(self.issues.journal_file, 'w') as f:
+            f.write(entry + '\n')
+        self.issues = PyIssues(self.TEST_DIR)
+        self.assertFalse(os.path.exists(self.issues.journal_file))
+        self.assertEqual(self.issues.filter(), [])
+        
+        # committed ones are applied
+        with open(self.issues.journal_file, 'w') as f:
+            f.write(entry + '\n' + json.dumps({'commit': True}) + '\n')
+        self.issues = PyIssues(self.TEST_DIR)
+        self.assertFalse(os.path.exists(self.issues.journal_file))
+        self.assertEqual(self.issues.get(issue.uuid).description, 'Test A')
+        self.assertEqual(PyIssues(self.TEST_DIR).filter()[0]['uuid'], issue.uuid)
+        
+        # a commit interrupted after it was applied is just applied again
+        source = "{0}/log.txt".format(self.TEST_DIR)
+        with open(source, 'w') as f:
+            f.write("log data\n")
+        issue = self.issues.get(issue.uuid)
+        path = self.issues.blobs.path(issue.attach_file(source, 'bob')[1][7:])
+        other = self.issues.create(description='Test B')
+        self.issues.update(other)
+        journal = '\n'.join([json.dumps({'uuid': issue.uuid, 'data': issue.as_dict()}),
+                             json.dumps({'uuid': other.uuid, 'data': None}), json.dumps({'commit': True}), ''])
+        for i in range(2):
+            with open(self.issues.journal_file, 'w') as f:
+                # anything after the last commit marker is dropped
+                f.write(journal + json.dumps({'uuid': other.uuid, 'data': other.as_dict()}) + '\n')
+            self.issues = PyIssues(self.TEST_DIR)
+            self.assertEqual([ x['uuid'] for x in self.issues.filter() ], [issue.uuid])
+            self.assertEqual(self.issues.get(issue.uuid).get_file(0)[1], os.path.realpath(path))
+            self.assertTrue(os.path.exists(path))
+        
+    def test_import_export(self):
+        from StringIO import StringIO
+        
+        for i in [ 'A', 'B', 'C' ]:
+            issue = self.issues.create(description=u"Test {0} \u00e9".format(i), status='closed' if i == 'B' else 'open')
+            issue.add_comment('Comment', 'bob')
+            self.issues.update(issue)
+        expected = self.issues.filter(sort='description')
+        
+        jsonl = StringIO()
+        self.assertEqual(self.issues.export_issues(jsonl), 3)
+        csv = StringIO()
+        self.assertEqual(self.issues.export_issues(csv, 'csv', {'status': 'open'}), 2)
+        self.assertEqual(len(csv.getvalue().splitlines()), 3)
+        
+        shutil.rmtree(self.TEST_DIR)
+        self.issues = PyIssues(self.TEST_DIR)
+        jsonl.seek(0)
+        flushes, written = [], []
+        flush, checkpoint = self.issues.flush, self.issues.checkpoint
+        self.issues.flush = lambda: flushes.append(len(self.issues._delta)) or flush()
+        self.issues.checkpoint = lambda: checkpoint() or written.append(len(os.listdir(self.issues.obj_dir)))
+        self.assertEqual(self.issues.import_issues(jsonl, batch_size=2), 3)
+        # objects are written a batch at a time and the database saved once
+        self.assertEqual(written, [2, 3])
+        self.assertEqual(flushes, [3])
+        self.assertFalse(self.issues.dirty)
+        self.assertEqual(PyIssues(self.TEST_DIR).filter(sort='description'), expected)
+        self.assertEqual(self.issues.get(expected[0]['uuid']).comments[0][0], 'Comment')
+        
+        shutil.rmtree(self.TEST_DIR)
+        self.issues = PyIssues(self.TEST_DIR)
+        csv.seek(0)
+        self.assertEqual(self.issues.import_issues(csv, 'csv'), 2)
+        self.assertFieldEqual(self.issues.filter(sort='description'), 'description',
+                              [u'Test A \u00e9', u'Test C \u00e9'])
+        self.assertEqual(self.issues.filter(sort='description')[0]['created'], expected[0]['created'])
+        
+    def test_search(self):
+        from pyissues import search
+        
+        texts = [ ('Crash on startup', 'The server crashes when started twice'),
+                  ('Slow listing', 'Listing is slow on big trackers'),
+                  ('Startup banner', 'Show a banner on start up') ]
+        uuids = []
+        for description, body in texts:
+            issue = self.issues.create(description=description, body=body)
+            self.issues.update(issue)
+            uuids.append(issue.uuid)
+        
+        # same term frequency so the shorter document ranks first
+        self.assertFieldEqual([ x for x, score in self.issues.search('startup') ], 'description', ['Startup banner', 'Crash on startup'])
+        self.assertFieldEqual([ x for x, score in self.issues.search('banner') ], 'description', ['Startup banner'])
+        self.assertEqual(len(self.issues.search('start*')), 2)
+        self.assertFieldEqual([ x for x, score in self.issues.search('"start up"') ], 'description', ['Startup banner'])
+        self.assertFieldEqual([ x for x, score in self.issues.search('"up start"') ], 'description', [])
+        self.assertFieldEqual([ x for x, score in self.issues.search('slow trackers') ], 'description', ['Slow listing'])
+        self.assertEqual(self.issues.search('missing'), [])
+        
+        # rows as from filter, with the score alongside
+        row, score = self.issues.search('banner')[0]
+        self.assertEqual(row, self.issues.filter({'uuid': uuids[2]})[0])
+        self.assertEqual(row.as_dict()['uuid'], uuids[2])
+        self.assertTrue(score > 0)
+        with self.assertRaises(TypeError):
+            row['status'] = 'closed'
+        
+        # comments are indexed and changes are incremental
+        issue = self.issues.get(uuids[1])
+        issue.add_comment('Seen after startup too', 'bob')
+        self.issues.update(issue)
+        self.issues.delete(uuids[0])
+        self.assertFieldEqual([ x for x, score in self.issues.search('startup') ], 'description', ['Startup banner', 'Slow listing'])
+        
+        # persisted and rebuilt
+        self.issues.close()
+        self.issues = PyIssues(self.TEST_DIR)
+        self.issues.update(self.issues.create(description='Another startup bug'))
+        self.assertEqual(len(self.issues.search('startup')), 3)
+        self.issues.rebuild()
+        self.assertEqual(len(self.issues.search('startup')), 3)
+        self.assertEqual(len(self.issues.search('startup', limit=1)), 1)
+        self.issues.flush()
+        
+        # saving only rewrites the shards a change touches
+        directory = self.issues.search_index.directory
+        shards = lambda: dict((x, os.stat(os.path.join(directory, x)).st_ino) for x in os.listdir(directory))
+        before = shards()
+        issue = self.issues.get(uuids[1])
+        issue.status = 'closed'
+        self.issues.update(issue)
+        self.issues.flush()
+        self.assertEqual(shards(), before)
+        
+        issue.add_comment('Zebra', 'bob')
+        self.issues.update(issue)
+        self.issues.flush()
+        after = shards()
+        self.assertEqual(sorted(x for x in after if after[x] != before.get(x)),
+                         sorted(['meta', 't-7a65', search.shard('d', issue.uuid), search.shard('l', issue.uuid)]))
+        self.assertFieldEqual([ x for x, score in PyIssues(self.TEST_DIR).search('zebra') ], 'description', ['Slow listing'])
+        
+    def test_attachments(self):
+        source = "{0}/log.txt".format(self.TEST_DIR)
+        with open(source, 'w') as f:
+            f.write("log data\n" * 1000)
+        
+        first = self.issues.create(description='Test A')
+        second = self.issues.create(description='Test B')
+        a = first.attach_file(source, 'bob')
+        first.attach_file(source, 'bob')
+        b = second.attach_file(source, 'bob')
+        self.issues.update(first)
+        self.issues.update(second)
+        
+        # stored once and shared
+        self.assertEqual(a[1], b[1])
+        self.assertEqual(a[0], 'log.txt')
+        name, path = first.get_file(0)
+        self.assertEqual(name, 'log.txt')
+        self.assertEqual(open(path).read(), open(source).read())
+        self.assertEqual(second.get_file(0)[1], path)
+        
+        # kept while anything, even a packed issue, still points at them
+        first.remove_file(1)
+        self.issues.update(first)
+        self.issues.delete(first.uuid)
+        second.status = 'closed'
+        self.issues.update(second)
+        self.issues.pack(days=0)
+        self.assertEqual(self.issues.prune_files(), 0)
+        self.assertTrue(os.path.exists(path))
+        
+        second = self.issues.get(second.uuid)
+        second.remove_file(0)
+        self.issues.update(second)
+        self.assertTrue(os.path.exists(path))
+        
+        # stored again after the scan started so it may be in use
+        self.assertEqual(self.issues.blobs.prune(set(), os.stat(path).st_mtime), [])
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.issues.prune_files(), 1)
+        self.assertFalse(os.path.exists(path))
+        
+    def test_file_ranges(self):
+        from StringIO import StringIO
+        from pyissues import util
+        
+        path = "{0}/data".format(self.TEST_DIR)
+        lines = [ "line {0}\n".format(i) for i in range(10000) ]
+        with open(path, 'wb') as f:
+            f.write(''.join(lines))
+        
+        with open(path, 'rb') as f:
+            out = StringIO()
+            self.assertEqual(util.copy_range(f, out), len(''.join(lines)))
+            self.assertEqual(out.getvalue(), ''.join(lines))
+            
+            out = StringIO()
+            self.assertEqual(util.copy_range(f, out, 5, 10), 10)
+            self.assertEqual(out.getvalue(), ''.join(lines)[5:15])
+            
+            self.assertEqual(util.head_length(f, 3), len(''.join(lines[:3])))
+            self.assertEqual(util.tail_offset(f, 2), len(''.join(lines[:-2])))
+            self.assertEqual(util.tail_offset(f, 20000), 0)
+            self.assertEqual(util.tail_offset(f, 0), len(''.join(lines)))
+            self.assertEqual(util.head_length(f, 0), 0)
+            self.assertEqual(util.head_length(f, 20000), len(''.join(lines)))
+        
+        # lines longer than a chunk
+        with open(path, 'wb') as f:
+            f.write('x' * (util.CHUNK_SIZE * 2 + 10) + '\nshort\n' + 'y' * 10)
+        with open(path, 'rb') as f:
+            self.assertEqual(util.head_length(f, 1), util.CHUNK_SIZE * 2 + 11)
+            self.assertEqual(util.head_length(f, 2), util.CHUNK_SIZE * 2 + 17)
+            self.assertEqual(util.head_length(f, 3), util.CHUNK_SIZE * 2 + 27)
+        with open(path, 'wb') as f:
+            f.write(''.join(lines))
+        
+        # real files can go through sendfile
+        target = "{0}/copy".format(self.TEST_DIR)
+        with open(path, 'rb') as f:
+            with open(target, 'wb') as out:
+                util.copy_range(f, out, util.tail_offset(f, 5))
+        self.assertEqual(open(target).read(), ''.join(lines[-5:]))
+        
+    def test_serializers(self):
+        issue = self.issues.create(description=u'Test \u00e9')
+        issue.add_comment('Comment', 'bob')
+        self.issues.update(issue)
+        path = self.issues.match(issue.uuid)
+        self.assertEqual(open(path).read(), str(issue))
+        
+        # marshal is never read from a header, only as the default
+        import marshal
+        bad = self.issues.create(description='Bad')
+        with open('{0}/{1}'.format(self.issues.obj_dir, bad.uuid), 'wb') as f:
+            f.write(pyissues.serializers.HEADER + '\x01' + marshal.dumps(bad.as_dict()))
+        with self.assertRaises(ValueError):
+            self.issues.get(bad.uuid)
+        os.unlink('{0}/{1}'.format(self.issues.obj_dir, bad.uuid))
+        
+        # switch formats, JSON objects still load
+        self.issues.settings['_serializer'] = 'marshal'
+        self.issues.serializer = pyissues.serializers.Store('marshal')
+        
+        other = self.issues.create(description='Test 2')
+        self.issues.update(other)
+        self.assertEqual(marshal.loads(open(self.issues.match(other.uuid), 'rb').read())['description'], 'Test 2')
+        self.assertEqual(self.issues.get(issue.uuid).description, u'Test \u00e9')
+        self.assertEqual(self.issues.get(other.uuid).description, 'Test 2')
+        
+        self.issues.update(self.issues.get(issue.uuid))
+        self.assertEqual(self.issues.get(issue.uuid).comments[0][0], 'Comment')
+        self.assertEqual(self.issues.rebuild(), 2)
+        self.assertFieldEqual(self.issues.filter(sort='description'), 'description', ['Test 2', u'Test \u00e9'])
+        
     def test_update(self):
         # switch to
         orig = pyissues.DATETIME_FORMAT
@@ -116,6 +1064,76 @@ class TestPyIssues(unittest.TestCase):
         # check the timestamp was updated
         self.assertGreater(issue.updated, updated)
         
+    def test_settings_cache(self):
+        import marshal
+        filename = os.path.join(self.TEST_DIR, 'conf.py')
+        cache = os.path.join(self.TEST_DIR, '.conf.cache')
+        
+        with open(filename, 'w') as f:
+            f.write("answer = 10\n")
+        self.assertEqual(pyissues.load_settings(self.TEST_DIR)['answer'], 10)
+        self.assertTrue(os.path.exists(cache))
+        
+        # a hit uses the cached code rather than parsing conf.py
+        with open(cache, 'rb') as f:
+            stamp = marshal.load(f)
+        with open(cache, 'wb') as f:
+            marshal.dump(stamp, f)
+            marshal.dump(compile("answer = 20\n", filename, 'exec'), f)
+        self.assertEqual(pyissues.load_settings(self.TEST_DIR)['answer'], 20)
+        
+        # changed in place
+        s = os.stat(filename)
+        with open(filename, 'w') as f:
+            f.write("answer = 30\n")
+        os.utime(filename, (s.st_atime, int(s.st_mtime) + 1))
+        self.assertEqual(pyissues.load_settings(self.TEST_DIR)['answer'], 30)
+        
+        # replaced by a file of the same size and mtime
+        s = os.stat(filename)
+        with open(filename + '.new', 'w') as f:
+            f.write("answer = 40\n")
+        os.utime(filename + '.new', (s.st_atime, s.st_mtime))
+        os.rename(filename + '.new', filename)
+        self.assertEqual(pyissues.load_settings(self.TEST_DIR)['answer'], 40)
+        
+        # an unreadable cache is just rebuilt
+        with open(cache, 'wb') as f:
+            f.write('junk')
+        self.assertEqual(pyissues.load_settings(self.TEST_DIR)['answer'], 40)
+        
+        os.unlink(filename)
+        self.assertNotIn('answer', pyissues.load_settings(self.TEST_DIR))
+    
+    def test_parse_options(self):
+        script = load_script()
+        
+        self.assertEqual(script.parse_options(['list']),
+                         ({'directory': 'issues', 'verbose': False, 'local': False, 'profile': False, 'profile_dump': None}, 'list', []))
+        
+        options, action, remaining = script.parse_options(['-v', '--directory', 'x', '--profile-dump=out', 'list', '-v', '--sort', 'owner'])
+        self.assertEqual((options['verbose'], options['directory'], options['profile_dump']), (True, 'x', 'out'))
+        # options after the action are still global, anything else is the action's
+        self.assertEqual((action, remaining), ('list', ['--sort', 'owner']))
+        
+        options, action, remaining = script.parse_options(['-d=y', '--local', '--profile', 'comment', 'abc', 'text'])
+        self.assertEqual((options['directory'], options['local'], options['profile']), ('y', True, True))
+        self.assertEqual((action, remaining), ('comment', ['abc', 'text']))
+        self.assertTrue(script.is_local(action, remaining[:1]))
+        self.assertFalse(script.is_local(action, remaining))
+        
+        # --help after the action is the action's
+        self.assertEqual(script.parse_options(['list', '--help'])[2], ['--help'])
+        
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            for args in ([], ['-v'], ['--directory'], ['--help']):
+                self.assertRaises(SystemExit, script.parse_options, args)
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+    
     def test_persistence(self):
         issue = self.issues.create(description='Test 1')
         self.issues.update(issue)